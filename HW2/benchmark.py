@@ -0,0 +1,36 @@
+"""Microbenchmark of LRUCache: cost per operation against capacity"""
+import argparse
+import random
+from time import perf_counter
+
+from cache import LRUCache
+
+
+def run(capacity: int, ops: int) -> float:
+    """Fill a cache to capacity, then time a mix of hits, misses and
+    evicting inserts. Return nanoseconds per operation"""
+    cache = LRUCache(capacity)
+    for i in range(capacity):
+        cache.set(str(i), 'value')
+    rnd = random.Random(capacity)
+    keys = [str(rnd.randrange(2 * capacity)) for _ in range(ops)]
+    get, set_ = cache.get, cache.set
+    start = perf_counter()
+    for key in keys:
+        if get(key) == '':
+            set_(key, 'value')
+    return (perf_counter() - start) / ops * 1e9
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-capacity', type=int, default=10 ** 7,
+                        help='largest capacity; 1e7 needs a few GB of memory')
+    parser.add_argument('--ops', type=int, default=10 ** 6)
+    args = parser.parse_args()
+
+    capacity = 1000
+    while capacity <= args.max_capacity:
+        print(f'capacity {capacity:>10}: '
+              f'{run(capacity, args.ops):7.1f} ns/op')
+        capacity *= 10
@@ -1,40 +1,266 @@
 """LRU algorithm"""
+import sys
+import threading
+import time
+
+
+class _Node:
+    """Entry of the recency list"""
+    __slots__ = ('prev', 'next', 'key', 'value')
 
 
 class LRUCache:
-    """LRU algorithm"""
+    """
+    LRU algorithm. A dict maps keys to the nodes of a circular doubly
+    linked list ordered from the most to the least recently used entry,
+    so get, set and delete are O(1)
+    """
     def __init__(self, capacity: int=10) -> None:
         self.capacity = capacity
-        self.time = 0
         self.cache = {}
-        self.timing = {}
+        self.root = _Node()
+        self.root.prev = self.root.next = self.root
+
+    def __len__(self) -> int:
+        return len(self.cache)
 
-    def get(self, key: str) -> str:
-        """Return value by key. If not exist return '' """
-        self.time += 1
-        self.timing[key] = self.time
-        return self.cache.get(key, '')
+    def __contains__(self, key: str) -> bool:
+        return key in self.cache
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist return default ('')"""
+        node = self.cache.get(key)
+        if node is None:
+            return default
+        root = self.root
+        if node.prev is not root:
+            node.prev.next = node.next
+            node.next.prev = node.prev
+            first = root.next
+            node.prev = root
+            node.next = first
+            first.prev = root.next = node
+        return node.value
 
     def set(self, key: str, value: str) -> None:
         """Set or update value by key"""
-        self.time += 1
-        if len(self.cache) < self.capacity:
-            self.cache[key] = value
-            self.timing[key] = self.time
+        root = self.root
+        node = self.cache.get(key)
+        if node is not None:
+            node.value = value
+            node.prev.next = node.next
+            node.next.prev = node.prev
+        elif len(self.cache) < self.capacity:
+            node = _Node()
+            node.key = key
+            node.value = value
+            self.cache[key] = node
+        elif self.capacity > 0:
+            # reuse the node of the least recently used entry
+            node = root.prev
+            node.prev.next = root
+            root.prev = node.prev
+            del self.cache[node.key]
+            node.key = key
+            node.value = value
+            self.cache[key] = node
         else:
-            if key in self.cache:
-                self.cache[key] = value
-                self.timing[key] = self.time
-            else:
-                min_time = min(self.timing.values())
-                keys = list(self.timing.keys())
-                del_key = keys[list(self.timing.values()).index(min_time)]
-                self.cache.pop(del_key)
-                self.timing.pop(del_key)
-                self.cache[key] = value
-                self.timing[key] = self.time
+            return
+        first = root.next
+        node.prev = root
+        node.next = first
+        first.prev = root.next = node
 
     def delete(self, key: str) -> None:
         """Delete element from dict if it exist"""
-        self.cache.pop(key, None)
-        self.timing.pop(key, None)
+        node = self.cache.pop(key, None)
+        if node is not None:
+            node.prev.next = node.next
+            node.next.prev = node.prev
+
+
+class _ShardNode(_Node):
+    """Entry of a shard's recency list"""
+    __slots__ = ('expires', 'size')
+
+
+def _sizeof(key: str, value: str) -> int:
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class CacheShard:
+    """
+    LRU cache with its own lock, bounded by item count and optionally by
+    bytes, with optional per-entry TTL and hit/miss/eviction statistics.
+    An entry larger than max_bytes is not stored and counted as rejected
+    """
+    def __init__(self, capacity: int=10, max_bytes: int=None,
+                 ttl: float=None, sizeof=_sizeof,
+                 clock=time.monotonic) -> None:
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self.cache = {}
+        self.root = _ShardNode()
+        self.root.prev = self.root.next = self.root
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist or expired return default"""
+        with self.lock:
+            node = self.cache.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+            if node.expires is not None and node.expires <= self.clock():
+                self._remove(node)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(node)
+            self._push(node)
+            return node.value
+
+    def set(self, key: str, value: str, ttl: float=None) -> None:
+        """Set or update value by key; ttl overrides the default TTL"""
+        size = self.sizeof(key, value)
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else self.clock() + ttl
+        with self.lock:
+            node = self.cache.get(key)
+            if node is not None:
+                self._remove(node)
+            if self.capacity <= 0:
+                return
+            if self.max_bytes is not None and size > self.max_bytes:
+                self.rejections += 1
+                return
+            while self.cache and (
+                    len(self.cache) >= self.capacity
+                    or self.max_bytes is not None
+                    and self.bytes + size > self.max_bytes):
+                self._remove(self.root.prev)
+                self.evictions += 1
+            node = _ShardNode()
+            node.key = key
+            node.value = value
+            node.expires = expires
+            node.size = size
+            self.cache[key] = node
+            self.bytes += size
+            self._push(node)
+
+    def delete(self, key: str) -> None:
+        """Delete element from dict if it exist"""
+        with self.lock:
+            node = self.cache.get(key)
+            if node is not None:
+                self._remove(node)
+
+    def stats(self) -> dict:
+        """Return counters and occupancy of the shard"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejections': self.rejections,
+                'items': len(self.cache),
+                'bytes': self.bytes,
+            }
+
+    def _push(self, node: _ShardNode) -> None:
+        first = self.root.next
+        node.prev = self.root
+        node.next = first
+        first.prev = self.root.next = node
+
+    @staticmethod
+    def _unlink(node: _ShardNode) -> None:
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def _remove(self, node: _ShardNode) -> None:
+        self._unlink(node)
+        del self.cache[node.key]
+        self.bytes -= node.size
+
+
+def _share(total: int, parts: int) -> list:
+    """Split total into parts that differ by at most one"""
+    quotient, remainder = divmod(total, parts)
+    return [quotient + (part < remainder) for part in range(parts)]
+
+
+class ShardedLRUCache:
+    """
+    Thread-safe LRU cache splitting the keys over independently locked
+    shards, so threads working on different shards do not wait for each
+    other. capacity and max_bytes are shared out evenly between shards.
+    Every shard evicts on its own once it is full, so by default the
+    number of shards is cut to keep at least MIN_SHARD_CAPACITY entries
+    in each: tiny shards would evict long before the cache holds
+    capacity entries. A shards value given explicitly is kept (up to
+    one shard per entry).
+
+    A shard can't hold an entry larger than its share of max_bytes, so
+    max_entry_bytes, about max_bytes / shards, is the largest entry the
+    cache stores; larger ones are counted in the shards' rejections
+    """
+    MIN_SHARD_CAPACITY = 64
+    DEFAULT_SHARDS = 16
+
+    def __init__(self, capacity: int=10, shards: int=None,
+                 max_bytes: int=None, ttl: float=None, sizeof=_sizeof,
+                 clock=time.monotonic) -> None:
+        if shards is None:
+            shards = min(self.DEFAULT_SHARDS,
+                         capacity // self.MIN_SHARD_CAPACITY)
+        shards = max(1, min(shards, capacity))
+        capacities = _share(max(capacity, 0), shards)
+        if max_bytes is None:
+            shard_bytes = [None] * shards
+            self.max_entry_bytes = None
+        else:
+            shard_bytes = _share(max(max_bytes, 0), shards)
+            self.max_entry_bytes = min(shard_bytes)
+        self.shards = [CacheShard(shard_capacity, max_shard_bytes, ttl,
+                                  sizeof, clock)
+                       for shard_capacity, max_shard_bytes
+                       in zip(capacities, shard_bytes)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def shard(self, key: str) -> CacheShard:
+        """Return the shard holding key"""
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist or expired return default"""
+        return self.shard(key).get(key, default)
+
+    def set(self, key: str, value: str, ttl: float=None) -> None:
+        """Set or update value by key; ttl overrides the default TTL"""
+        self.shard(key).set(key, value, ttl)
+
+    def delete(self, key: str) -> None:
+        """Delete element from dict if it exist"""
+        self.shard(key).delete(key)
+
+    def stats(self) -> list:
+        """Return the statistics of every shard"""
+        return [shard.stats() for shard in self.shards]
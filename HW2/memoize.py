@@ -0,0 +1,153 @@
+"""Memoization decorators on top of LRUCache"""
+import asyncio
+from collections import namedtuple
+from concurrent.futures import Future
+import functools
+import threading
+import time
+
+from cache import LRUCache
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+MISSING = object()
+_KWD_MARK = object()
+
+
+def _make_key(args: tuple, kwargs: dict) -> tuple:
+    """Key of a call; all arguments must be hashable. Keyword arguments
+    given in another order make another key"""
+    if kwargs:
+        return args + (_KWD_MARK,) + tuple(kwargs.items())
+    return args
+
+
+class _Memo:
+    """Results of one memoized function with their expiry times"""
+    def __init__(self, maxsize: int, ttl: float, clock) -> None:
+        self.cache = LRUCache(maxsize)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: tuple):
+        """Return the cached result of a call or MISSING"""
+        entry = self.cache.get(key, MISSING)
+        if entry is MISSING:
+            return MISSING
+        expires, result = entry
+        if expires is not None and expires <= self.clock():
+            self.cache.delete(key)
+            return MISSING
+        self.hits += 1
+        return result
+
+    def store(self, key: tuple, result) -> None:
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self.cache.set(key, (expires, result))
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self.cache))
+
+    def clear(self) -> None:
+        self.cache = LRUCache(self.maxsize)
+        self.hits = self.misses = 0
+
+
+def lru_memoize(maxsize: int=128, ttl: float=None, clock=time.monotonic):
+    """
+    Cache the results of a function in an LRUCache of maxsize entries,
+    for ttl seconds if given. Concurrent calls with the same arguments
+    wait for the first one instead of calling the function again
+    (exceptions are passed to all of them and are not cached). The
+    wrapper has cache_info() and cache_clear() like functools.lru_cache
+    """
+    def decorator(func):
+        memo = _Memo(maxsize, ttl, clock)
+        pending = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            with lock:
+                result = memo.lookup(key)
+                if result is not MISSING:
+                    return result
+                future = pending.get(key)
+                leader = future is None
+                if leader:
+                    future = pending[key] = Future()
+                    memo.misses += 1
+                else:
+                    memo.hits += 1
+            if not leader:
+                return future.result()
+
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as error:
+                with lock:
+                    del pending[key]
+                future.set_exception(error)
+                raise
+            with lock:
+                memo.store(key, result)
+                del pending[key]
+            future.set_result(result)
+            return result
+
+        def cache_info() -> CacheInfo:
+            with lock:
+                return memo.info()
+
+        def cache_clear() -> None:
+            with lock:
+                memo.clear()
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+def async_lru_memoize(maxsize: int=128, ttl: float=None,
+                      clock=time.monotonic):
+    """
+    lru_memoize for coroutine functions: concurrent awaits with the same
+    arguments share one task, which keeps running when the caller that
+    started it is cancelled
+    """
+    def decorator(func):
+        memo = _Memo(maxsize, ttl, clock)
+        pending = {}
+
+        def done(key: tuple, task: asyncio.Task) -> None:
+            del pending[key]
+            if not task.cancelled() and task.exception() is None:
+                memo.store(key, task.result())
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            result = memo.lookup(key)
+            if result is not MISSING:
+                return result
+            task = pending.get(key)
+            if task is not None:
+                memo.hits += 1
+            else:
+                task = pending[key] = asyncio.ensure_future(
+                    func(*args, **kwargs))
+                task.add_done_callback(functools.partial(done, key))
+                memo.misses += 1
+            return await asyncio.shield(task)
+
+        wrapper.cache_info = memo.info
+        wrapper.cache_clear = memo.clear
+        return wrapper
+    return decorator
@@ -0,0 +1,259 @@
+"""
+Scan-resistant eviction policies with the get/set/delete interface of
+LRUCache: segmented LRU, 2Q and W-TinyLFU
+"""
+from collections import OrderedDict
+
+from cache import LRUCache
+
+
+class SLRUCache:
+    """
+    Segmented LRU. New entries go to the probation segment; a hit there
+    promotes the entry to the protected segment, whose least recently
+    used entries are demoted back to probation. Entries seen only once,
+    like the keys of a scan, are evicted from probation without touching
+    the protected ones
+    """
+    def __init__(self, capacity: int=10,
+                 protected_ratio: float=0.8) -> None:
+        self.capacity = capacity
+        self.protected_capacity = int(capacity * protected_ratio)
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.probation) + len(self.protected)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.probation or key in self.protected
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist return default ('')"""
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        if key in self.probation:
+            value = self.probation.pop(key)
+            self._protect(key, value)
+            return value
+        return default
+
+    def set(self, key: str, value: str) -> None:
+        """Set or update value by key"""
+        if key in self.protected:
+            self.protected[key] = value
+            self.protected.move_to_end(key)
+        elif key in self.probation:
+            del self.probation[key]
+            self._protect(key, value)
+        elif self.capacity > 0:
+            if len(self) >= self.capacity:
+                self.evict()
+            self.probation[key] = value
+
+    def delete(self, key: str) -> None:
+        """Delete element from dict if it exist"""
+        self.probation.pop(key, None)
+        self.protected.pop(key, None)
+
+    def victim(self) -> str:
+        """Return the key that evict() would remove"""
+        segment = self.probation or self.protected
+        return next(iter(segment))
+
+    def evict(self) -> None:
+        """Remove the least recently used entry of probation, or of the
+        protected segment when probation is empty"""
+        (self.probation or self.protected).popitem(last=False)
+
+    def _protect(self, key: str, value: str) -> None:
+        self.protected[key] = value
+        if len(self.protected) > self.protected_capacity:
+            demoted, demoted_value = self.protected.popitem(last=False)
+            self.probation[demoted] = demoted_value
+
+
+class TwoQueueCache:
+    """
+    2Q (Johnson and Shasha). New entries wait in the A1in FIFO; the keys
+    leaving it are remembered in the A1out ghost queue, and only a key
+    set again while remembered there enters the Am LRU holding the
+    frequently used entries
+    """
+    def __init__(self, capacity: int=10, in_ratio: float=0.25,
+                 out_ratio: float=0.5) -> None:
+        self.capacity = capacity
+        self.in_capacity = max(1, int(capacity * in_ratio))
+        self.out_capacity = max(1, int(capacity * out_ratio))
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.a1in) + len(self.am)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.am or key in self.a1in
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist return default ('')"""
+        if key in self.am:
+            self.am.move_to_end(key)
+            return self.am[key]
+        return self.a1in.get(key, default)
+
+    def set(self, key: str, value: str) -> None:
+        """Set or update value by key"""
+        if key in self.am:
+            self.am[key] = value
+            self.am.move_to_end(key)
+            return
+        if key in self.a1in:
+            self.a1in[key] = value
+            return
+        if self.capacity <= 0:
+            return
+        if len(self) >= self.capacity:
+            self._reclaim()
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = value
+        else:
+            self.a1in[key] = value
+
+    def delete(self, key: str) -> None:
+        """Delete element from dict if it exist"""
+        self.am.pop(key, None)
+        self.a1in.pop(key, None)
+        self.a1out.pop(key, None)
+
+    def _reclaim(self) -> None:
+        if len(self.a1in) > self.in_capacity or not self.am:
+            key, _ = self.a1in.popitem(last=False)
+            self.a1out[key] = None
+            if len(self.a1out) > self.out_capacity:
+                self.a1out.popitem(last=False)
+        else:
+            self.am.popitem(last=False)
+
+
+class CountMinSketch:
+    """
+    Approximate access counts in depth rows of width counters, capped at
+    15. Once sample_size accesses were counted all counters are halved,
+    so old popularity fades
+    """
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+             0xD6E8FEB86659FD93)
+    MASK = (1 << 64) - 1
+
+    def __init__(self, width: int, sample_size: int,
+                 depth: int=4) -> None:
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.depth = min(depth, len(self.SEEDS))
+        self.rows = [bytearray(self.width) for _ in range(self.depth)]
+        self.sample_size = sample_size
+        self.additions = 0
+
+    def _indexes(self, key: str):
+        h = hash(key) & self.MASK
+        shift = 64 - self.width.bit_length() + 1
+        for seed in self.SEEDS[:self.depth]:
+            yield ((h * seed) & self.MASK) >> shift
+
+    def add(self, key: str) -> None:
+        for row, i in zip(self.rows, self._indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+    def reset(self) -> None:
+        for row in self.rows:
+            row[:] = bytes(count >> 1 for count in row)
+        self.additions //= 2
+
+
+class WTinyLFUCache:
+    """
+    W-TinyLFU (Einziger, Friedman and Manes). New entries enter a small
+    LRU window; an entry leaving the window replaces the main segmented
+    LRU's victim only if a count-min sketch of recent accesses says it
+    is used more often. Accesses are counted on get()
+    """
+    def __init__(self, capacity: int=10, window_ratio: float=0.01) -> None:
+        self.capacity = capacity
+        window_capacity = max(1, int(capacity * window_ratio))
+        if capacity <= 1:
+            window_capacity = capacity
+        self.window = LRUCache(window_capacity)
+        self.window_capacity = window_capacity
+        self.main = SLRUCache(capacity - window_capacity)
+        self.sketch = CountMinSketch(max(capacity, 16),
+                                     sample_size=10 * max(capacity, 16))
+
+    def __len__(self) -> int:
+        return len(self.window) + len(self.main)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.window or key in self.main
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist return default ('')"""
+        self.sketch.add(key)
+        if key in self.window:
+            return self.window.get(key)
+        return self.main.get(key, default)
+
+    def set(self, key: str, value: str) -> None:
+        """Set or update value by key"""
+        if key in self.main:
+            self.main.set(key, value)
+            return
+        if key in self.window or self.window_capacity <= 0:
+            self.window.set(key, value)
+            return
+        if len(self.window) >= self.window_capacity:
+            candidate = self.window.root.prev
+            self._admit(candidate.key, candidate.value)
+        self.window.set(key, value)
+
+    def delete(self, key: str) -> None:
+        """Delete element from dict if it exist"""
+        self.window.delete(key)
+        self.main.delete(key)
+
+    def _admit(self, key: str, value: str) -> None:
+        """Move the window's victim to the main segment if it is used more
+        often than the main segment's victim, else drop it"""
+        self.window.delete(key)
+        main = self.main
+        if main.capacity <= 0:
+            return
+        if len(main) >= main.capacity:
+            if self.sketch.estimate(key) <= \
+                    self.sketch.estimate(main.victim()):
+                return
+            main.evict()
+        main.set(key, value)
+
+
+POLICIES = {
+    'lru': LRUCache,
+    'slru': SLRUCache,
+    '2q': TwoQueueCache,
+    'w-tinylfu': WTinyLFUCache,
+}
+
+
+def make_cache(policy: str, capacity: int):
+    """Return an empty cache of capacity entries using the named policy"""
+    try:
+        return POLICIES[policy](capacity)
+    except KeyError:
+        raise ValueError(f'Unknown cache policy "{policy}"') from None
@@ -0,0 +1,227 @@
+"""
+Off-heap cache in a memory-mapped file, shared by the processes that
+open the same path and kept across their restarts
+"""
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+# magic, version, slots, ways, key size, value size, items
+_HEADER = struct.Struct('<4sIIIIII')
+_HEADER_SIZE = 64
+_MAGIC = b'LRUC'
+_VERSION = 1
+# used, referenced, key length, value length, key hash
+_SLOT = struct.Struct('<BBHIQ')
+
+
+def _hash(key: bytes) -> int:
+    """Hash of a key that is the same in every process"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(),
+                          'little')
+
+
+class SharedCache:
+    """
+    Cache of str keys and values stored in a file mapped into memory.
+
+    The file holds an open addressing hash table of fixed-size slots
+    grouped in buckets of `ways` slots: a key is probed only within the
+    bucket its hash selects, so a lookup reads at most `ways` slots.
+    A new key going to a full bucket evicts one of its entries with the
+    CLOCK algorithm: the bucket's hand sweeps the slots clearing their
+    referenced bits (set by gets and updates, not by inserts, so keys
+    seen once go first) and takes the first entry not referenced since
+    the previous sweep. Keys and values longer than key_size or
+    value_size bytes in UTF-8 are not cached.
+
+    Processes are serialized by flock() on the file and threads by a
+    lock. A process opening an existing file reuses its entries; a file
+    of another geometry is refused rather than rebuilt under the
+    processes that map it. An entry is published by setting its used
+    byte after the key and value are written, so a process killed in
+    set() leaves no torn entry behind
+    """
+    def __init__(self, path: str, slots: int=65536, key_size: int=64,
+                 value_size: int=256, ways: int=8) -> None:
+        self.path = path
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        self.slots = self.buckets * ways
+        self.key_size = key_size
+        self.value_size = value_size
+        self.slot_size = _SLOT.size + key_size + value_size
+        # the bucket hands follow the header, the slots follow the hands
+        self.slots_offset = _HEADER_SIZE + self.buckets
+        self.size = self.slots_offset + self.slots * self.slot_size
+        self.hits = 0
+        self.misses = 0
+        self._open()
+
+    def __len__(self) -> int:
+        with self._locked(fcntl.LOCK_SH):
+            return self._read_count()
+
+    def get(self, key: str, default: str='') -> str:
+        """Return value by key. If not exist return default ('')"""
+        raw = key.encode('utf-8')
+        with self._locked(fcntl.LOCK_SH):
+            offset = self._find(raw, _hash(raw))
+            value = None
+            if offset is not None:
+                value_len = _SLOT.unpack_from(self.mm, offset)[3]
+                start = offset + _SLOT.size + self.key_size
+                if value_len <= self.value_size:
+                    try:
+                        value = self.mm[start:start + value_len] \
+                            .decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+            if value is None:
+                self.misses += 1
+                return default
+            self.mm[offset + 1] = 1
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        """Set or update value by key"""
+        raw = key.encode('utf-8')
+        raw_value = value.encode('utf-8')
+        if len(raw) > self.key_size or len(raw_value) > self.value_size:
+            self.delete(key)
+            return
+        key_hash = _hash(raw)
+        with self._locked(fcntl.LOCK_EX):
+            offset = self._find(raw, key_hash)
+            referenced = offset is not None
+            if not referenced:
+                offset = self._free_slot(key_hash)
+            # unpublish the slot while it is rewritten
+            self.mm[offset] = 0
+            start = offset + _SLOT.size
+            self.mm[start:start + len(raw)] = raw
+            start += self.key_size
+            self.mm[start:start + len(raw_value)] = raw_value
+            _SLOT.pack_into(self.mm, offset, 0, referenced, len(raw),
+                            len(raw_value), key_hash)
+            self.mm[offset] = 1
+
+    def delete(self, key: str) -> None:
+        """Delete element from dict if it exist"""
+        raw = key.encode('utf-8')
+        with self._locked(fcntl.LOCK_EX):
+            offset = self._find(raw, _hash(raw))
+            if offset is not None:
+                self.mm[offset] = 0
+                self._write_count(self._read_count() - 1)
+
+    def clear(self) -> None:
+        with self._locked(fcntl.LOCK_EX):
+            self.mm[:] = bytes(self.size)
+            self._write_count(0)
+
+    def close(self) -> None:
+        self.mm.close()
+        os.close(self.fd)
+
+    def _open(self) -> None:
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(self.fd, _HEADER.size, 0)
+                # an empty file, or one whose creator died before writing
+                # the header
+                fresh = not header.strip(b'\0')
+                if fresh:
+                    os.ftruncate(self.fd, self.size)
+                elif not self._compatible(header):
+                    raise ValueError(f'{self.path} holds a cache of another '
+                                     'geometry')
+                self.mm = mmap.mmap(self.fd, self.size)
+                # the count may be off after a process died in set()
+                self._write_count(0 if fresh else self._recount())
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    @contextlib.contextmanager
+    def _locked(self, operation: int):
+        """Hold the thread lock and flock() on the file"""
+        if self.pid != os.getpid():
+            # a forked child shares the parent's open file description,
+            # and so its flock(), and may have copied a held thread lock
+            self.close()
+            self._open()
+        with self.lock:
+            fcntl.flock(self.fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _compatible(self, header: bytes) -> bool:
+        if os.fstat(self.fd).st_size != self.size:
+            return False
+        return _HEADER.unpack(header)[:6] == \
+            (_MAGIC, _VERSION, self.slots, self.ways, self.key_size,
+             self.value_size)
+
+    def _recount(self) -> int:
+        return sum(self.mm[offset] for offset in
+                   range(self.slots_offset, self.size, self.slot_size))
+
+    def _read_count(self) -> int:
+        return _HEADER.unpack_from(self.mm, 0)[6]
+
+    def _write_count(self, count: int) -> None:
+        _HEADER.pack_into(self.mm, 0, _MAGIC, _VERSION, self.slots,
+                          self.ways, self.key_size, self.value_size, count)
+
+    def _bucket(self, key_hash: int) -> int:
+        return key_hash % self.buckets
+
+    def _find(self, raw: bytes, key_hash: int):
+        """Return the offset of the slot holding the key or None"""
+        first = self.slots_offset + \
+            self._bucket(key_hash) * self.ways * self.slot_size
+        for offset in range(first, first + self.ways * self.slot_size,
+                            self.slot_size):
+            used, _, key_len, _, slot_hash = \
+                _SLOT.unpack_from(self.mm, offset)
+            if used and slot_hash == key_hash and key_len == len(raw):
+                start = offset + _SLOT.size
+                if self.mm[start:start + key_len] == raw:
+                    return offset
+        return None
+
+    def _free_slot(self, key_hash: int) -> int:
+        """Return the offset of an empty slot of the key's bucket, making
+        one with CLOCK if the bucket is full"""
+        bucket = self._bucket(key_hash)
+        first = self.slots_offset + bucket * self.ways * self.slot_size
+        for way in range(self.ways):
+            offset = first + way * self.slot_size
+            if not self.mm[offset]:
+                self._write_count(self._read_count() + 1)
+                return offset
+        hand_offset = _HEADER_SIZE + bucket
+        way = self.mm[hand_offset] % self.ways
+        while True:
+            offset = first + way * self.slot_size
+            way = (way + 1) % self.ways
+            if self.mm[offset + 1]:
+                self.mm[offset + 1] = 0
+            else:
+                self.mm[hand_offset] = way
+                return offset
+
@@ -0,0 +1,77 @@
+"""
+Trace-replay simulator of the cache policies. Each trace is a text file
+with one access per line (the first word of the line is the key); every
+access is a get() followed by a set() on a miss, like a read-through
+cache. Without traces a synthetic one is replayed: Zipf-distributed
+accesses to a hot set interrupted by one-off scans.
+
+    python simulate.py trace.txt --capacity 1000 10000
+"""
+import argparse
+from bisect import bisect
+from itertools import accumulate
+import random
+
+from policies import POLICIES, make_cache
+
+
+def read_trace(path: str) -> list:
+    with open(path, encoding='utf-8') as trace:
+        return [line.split()[0] for line in trace if line.strip()]
+
+
+def synthetic_trace(length: int=1000000, keys: int=100000,
+                    skew: float=1.0, scan_every: int=50000,
+                    scan_length: int=20000, seed: int=0) -> list:
+    """Zipf(skew) accesses over keys with a scan of scan_length new keys
+    every scan_every accesses"""
+    rnd = random.Random(seed)
+    weights = list(accumulate(1 / rank ** skew
+                              for rank in range(1, keys + 1)))
+    total = weights[-1]
+    trace = []
+    scans = 0
+    while len(trace) < length:
+        if trace and len(trace) % scan_every == 0:
+            trace.extend(f'scan{scans}-{i}' for i in range(scan_length))
+            scans += 1
+        trace.append(str(bisect(weights, rnd.random() * total)))
+    return trace[:length]
+
+
+def replay(trace: list, cache) -> float:
+    """Return the hit ratio of cache on trace"""
+    hits = 0
+    for key in trace:
+        if key in cache:
+            cache.get(key)
+            hits += 1
+        else:
+            cache.get(key)
+            cache.set(key, key)
+    return hits / len(trace) if trace else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('trace', nargs='*', help='trace files')
+    parser.add_argument('--capacity', type=int, nargs='+', default=[1000])
+    parser.add_argument('--policy', nargs='+', choices=list(POLICIES),
+                        default=list(POLICIES))
+    parser.add_argument('--length', type=int, default=1000000,
+                        help='length of the synthetic trace')
+    args = parser.parse_args()
+
+    traces = [(path, read_trace(path)) for path in args.trace]
+    if not traces:
+        traces = [('synthetic', synthetic_trace(args.length))]
+
+    print(f'{"trace":<20} {"capacity":>9} ' +
+          ' '.join(f'{policy:>10}' for policy in args.policy))
+    for name, trace in traces:
+        for capacity in args.capacity:
+            ratios = [replay(trace, make_cache(policy, capacity))
+                      for policy in args.policy]
+            print(f'{name:<20} {capacity:>9} ' +
+                  ' '.join(f'{ratio:>10.2%}' for ratio in ratios))
@@ -0,0 +1,377 @@
+import asyncio
+import fcntl
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from cache import LRUCache, ShardedLRUCache
+from memoize import CacheInfo, async_lru_memoize, lru_memoize
+from policies import POLICIES, CountMinSketch, make_cache
+import shared_cache
+from shared_cache import SharedCache
+from simulate import replay
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def hammer(func, threads=8, keys=2000):
+    """Run func(key) for keys keys in each of threads threads"""
+    def work(offset):
+        for i in range(keys):
+            func(str((i * 7919 + offset) % (keys * 2)))
+
+    workers = [threading.Thread(target=work, args=(offset,))
+               for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.set('Jesse', 'Pinkman')
+        cache.set('Walter', 'White')
+        cache.get('Jesse')
+        cache.set('Saul', 'Goodman')
+        self.assertEqual(cache.get('Walter'), '')
+        self.assertEqual(cache.get('Jesse'), 'Pinkman')
+        cache.delete('Jesse')
+        self.assertEqual(len(cache), 1)
+
+
+class TestShardedLRUCache(unittest.TestCase):
+
+    def test_capacity_shared_out(self):
+        for capacity, shards in ((10, 1), (100, 1), (1000, 15),
+                                 (10000, 16)):
+            cache = ShardedLRUCache(capacity)
+            self.assertEqual(len(cache.shards), shards)
+            self.assertEqual(sum(shard.capacity for shard in cache.shards),
+                             capacity)
+
+    def test_explicit_shards(self):
+        self.assertEqual(len(ShardedLRUCache(100, shards=4).shards), 4)
+        self.assertEqual(len(ShardedLRUCache(3, shards=8).shards), 3)
+
+    def test_entry_larger_than_shard_budget(self):
+        cache = ShardedLRUCache(100000, max_bytes=1000000,
+                                sizeof=lambda key, value: len(value))
+        self.assertEqual(cache.max_entry_bytes, 62500)
+        cache.set('small', 'x' * 62500)
+        cache.set('large', 'x' * 70000)
+        self.assertEqual(cache.get('small'), 'x' * 62500)
+        self.assertEqual(cache.get('large'), '')
+        self.assertEqual(sum(shard['rejections']
+                             for shard in cache.stats()), 1)
+
+    def test_small_cache_is_exact(self):
+        cache = ShardedLRUCache(10)
+        for i in range(10):
+            cache.set(str(i), str(i))
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.get('0'), '0')
+
+    def test_count_bound_under_threads(self):
+        cache = ShardedLRUCache(1000)
+        hammer(lambda key: cache.set(key, key))
+        self.assertEqual(len(cache), sum(len(shard.cache)
+                                         for shard in cache.shards))
+        self.assertLessEqual(len(cache), 1000)
+        for shard in cache.shards:
+            self.assertLessEqual(len(shard), shard.capacity)
+
+    def test_bytes_bound_under_threads(self):
+        cache = ShardedLRUCache(10000, max_bytes=5000,
+                                sizeof=lambda key, value: len(value))
+        hammer(lambda key: cache.set(key, key * 3))
+        stats = cache.stats()
+        self.assertLessEqual(sum(shard['bytes'] for shard in stats), 5000)
+        for shard in cache.shards:
+            self.assertLessEqual(shard.bytes, shard.max_bytes)
+            self.assertEqual(shard.bytes, sum(len(node.value) for node
+                                              in shard.cache.values()))
+
+    def test_ttl_under_threads(self):
+        clock = FakeClock()
+        cache = ShardedLRUCache(10000, ttl=10, clock=clock)
+        hammer(lambda key: cache.set(key, key))
+        clock.now = 5
+        self.assertEqual(cache.get('1'), '1')
+        cache.set('1', '1', ttl=20)
+        clock.now = 10
+        hits = []
+        hammer(lambda key: cache.get(key) and hits.append(key))
+        self.assertEqual(set(hits), {'1'})
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(sum(shard['expirations']
+                             for shard in cache.stats()), 3999)
+
+
+class TestMemoize(unittest.TestCase):
+
+    def test_cache(self):
+        calls = []
+
+        @lru_memoize(maxsize=2)
+        def square(x, power=2):
+            calls.append(x)
+            return x ** power
+
+        self.assertEqual([square(2), square(2), square(3), square(2),
+                          square(4), square(3)], [4, 4, 9, 4, 16, 9])
+        self.assertEqual(square(2, power=3), 8)
+        self.assertEqual(calls, [2, 3, 4, 3, 2])
+        self.assertEqual(square.cache_info(), CacheInfo(2, 5, 2, 2))
+        square.cache_clear()
+        self.assertEqual(square.cache_info(), CacheInfo(0, 0, 2, 0))
+
+    def test_ttl(self):
+        clock = FakeClock()
+        calls = []
+
+        @lru_memoize(ttl=10, clock=clock)
+        def identity(x):
+            calls.append(x)
+            return x
+
+        identity(1)
+        clock.now = 9
+        identity(1)
+        clock.now = 10
+        identity(1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @lru_memoize()
+        def slow(x):
+            calls.append(x)
+            started.set()
+            release.wait(5)
+            return x
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow(1)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((calls, results), ([1], [1] * 4))
+
+    def test_error_not_cached(self):
+        calls = []
+
+        @lru_memoize()
+        def fail(x):
+            calls.append(x)
+            raise KeyError(x)
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                fail(1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_async_single_flight(self):
+        calls = []
+
+        @async_lru_memoize()
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x
+
+        async def main():
+            first = asyncio.create_task(slow(1))
+            await asyncio.sleep(0)
+            first.cancel()
+            results = await asyncio.gather(slow(1), slow(1))
+            return results + [await slow(1)]
+
+        self.assertEqual(asyncio.run(main()), [1, 1, 1])
+        self.assertEqual(calls, [1])
+        self.assertEqual(slow.cache_info(), CacheInfo(3, 1, 128, 1))
+
+
+class TestPolicies(unittest.TestCase):
+
+    hot = [f'hot{i}' for i in range(5)]
+
+    def replay(self, cache):
+        """Touch the hot keys again after they left the cache's first
+        queue, then scan keys seen only once"""
+        trace = self.hot + [f'filler{i}' for i in range(20)] + self.hot * 3
+        replay(trace, cache)
+        replay([f'scan{i}' for i in range(50)], cache)
+
+    def test_scan_resistance(self):
+        for policy in ('slru', '2q', 'w-tinylfu'):
+            cache = make_cache(policy, 20)
+            self.replay(cache)
+            self.assertEqual([key for key in self.hot if key in cache],
+                             self.hot, policy)
+
+    def test_lru_flushed_by_scan(self):
+        cache = make_cache('lru', 20)
+        self.replay(cache)
+        self.assertFalse(any(key in cache for key in self.hot))
+
+    def test_interface(self):
+        for policy in POLICIES:
+            cache = make_cache(policy, 20)
+            for i in range(100):
+                cache.set(str(i % 30), str(i))
+                self.assertLessEqual(len(cache), 20, policy)
+            cache.set('key', 'value')
+            cache.set('key', 'updated')
+            self.assertEqual(cache.get('key'), 'updated', policy)
+            cache.delete('key')
+            self.assertEqual(cache.get('key', None), None, policy)
+            empty = make_cache(policy, 0)
+            empty.set('key', 'value')
+            self.assertEqual(len(empty), 0, policy)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            make_cache('fifo', 10)
+
+    def test_sketch(self):
+        sketch = CountMinSketch(64, sample_size=1000)
+        for i in range(20):
+            for _ in range(i % 16):
+                sketch.add(str(i))
+        for i in range(20):
+            self.assertGreaterEqual(sketch.estimate(str(i)), i % 16)
+        sketch.reset()
+        self.assertLessEqual(sketch.estimate('15'), 15 // 2 + 1)
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache')
+
+    def open(self, **geometry):
+        cache = SharedCache(self.path, **{'slots': 64, 'key_size': 16,
+                                          'value_size': 32, **geometry})
+        self.addCleanup(cache.close)
+        return cache
+
+    def fork(self, func):
+        """Run func in a child process and return its exit code"""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = func()
+            finally:
+                os._exit(status)
+        return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+    def test_get_set_delete(self):
+        cache = self.open()
+        cache.set('Jesse', 'Pinkman')
+        cache.set('Walter', 'White')
+        cache.set('Jesse', 'James')
+        self.assertEqual(cache.get('Jesse'), 'James')
+        cache.delete('Walter')
+        self.assertEqual(cache.get('Walter'), '')
+        cache.set('long', 'x' * 33)
+        self.assertEqual(cache.get('long', None), None)
+        self.assertEqual(len(cache), 1)
+
+    def test_visible_across_processes(self):
+        cache = self.open()
+        cache.set('parent', 'set before the fork')
+
+        def child():
+            if cache.get('parent') != 'set before the fork':
+                return 1
+            cache.set('child', 'set in the child')
+            return 0
+
+        self.assertEqual(self.fork(child), 0)
+        self.assertEqual(cache.get('child'), 'set in the child')
+        self.assertEqual(len(cache), 2)
+
+    def test_lock_across_fork(self):
+        cache = self.open()
+        ready, go = os.pipe()
+        self.addCleanup(os.close, ready)
+        self.addCleanup(os.close, go)
+
+        def child():
+            os.read(ready, 1)
+            start = time.monotonic()
+            cache.set('child', 'waited')
+            return 0 if time.monotonic() - start >= 0.2 else 1
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = child()
+            finally:
+                os._exit(status)
+        with cache._locked(fcntl.LOCK_EX):
+            os.write(go, b'x')
+            time.sleep(0.3)
+        status = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+        self.assertEqual(status, 0)
+        self.assertEqual(cache.get('child'), 'waited')
+
+    def test_clock_eviction(self):
+        cache = self.open(slots=4, ways=4)
+        for key in 'abcd':
+            cache.set(key, key)
+        cache.get('a')
+        cache.get('c')
+        cache.set('e', 'e')
+        cache.set('f', 'f')
+        # the hand clears a's referenced bit and takes b for e, then
+        # clears c's and takes d for f
+        self.assertEqual([key for key in 'abcdef' if cache.get(key)],
+                         ['a', 'c', 'e', 'f'])
+
+    def test_reopen(self):
+        cache = SharedCache(self.path, slots=64, key_size=16, value_size=32)
+        cache.set('kept', 'across restarts')
+        cache.close()
+        cache = self.open()
+        self.assertEqual(cache.get('kept'), 'across restarts')
+        self.assertEqual(len(cache), 1)
+        with self.assertRaises(ValueError):
+            self.open(slots=128)
+        self.assertEqual(cache.get('kept'), 'across restarts')
+
+    def test_torn_entry(self):
+        cache = self.open()
+        cache.set('key', 'value')
+        offset = cache._find(b'key', shared_cache._hash(b'key'))
+        start = offset + shared_cache._SLOT.size + cache.key_size
+        cache.mm[start:start + 2] = b'\xff\xfe'
+        self.assertEqual(cache.get('key'), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
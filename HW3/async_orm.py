@@ -0,0 +1,620 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import itertools
+import time
+import weakref
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+import config
+from cache import row_cache
+from connection import PoolTimeout
+from instrumentation import query_stats
+import logger
+from orm import (DatabaseORM, MetaORM, SQLQuery, TableExists, TableNotFound,
+                 MethodUsageError)
+
+
+logger = logger.get_logger(__name__)
+
+
+class AsyncPsycopg2:
+    '''
+    Minimal asyncio driver over psycopg2's asynchronous connections:
+    the connection socket is watched by the event loop instead of
+    blocking a thread.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.cursor = None
+
+    @classmethod
+    async def connect(cls, **db_data):
+        driver = cls(psycopg2.connect(async_=True, **db_data))
+        await driver._wait()
+        driver.cursor = driver.db.cursor()
+        return driver
+
+    async def execute(self, query, params=None):
+        self.cursor.execute(query, params)
+        try:
+            await self._wait()
+        except asyncio.CancelledError:
+            self.close()
+            raise
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def closed(self):
+        return bool(self.db.closed)
+
+    def close(self):
+        self.db.close()
+
+    async def _wait(self):
+        loop = asyncio.get_running_loop()
+        fd = self.db.fileno()
+        while True:
+            state = self.db.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            future = loop.create_future()
+            ready = lambda: future.done() or future.set_result(None)
+            if state == psycopg2.extensions.POLL_READ:
+                loop.add_reader(fd, ready)
+                remove = loop.remove_reader
+            elif state == psycopg2.extensions.POLL_WRITE:
+                loop.add_writer(fd, ready)
+                remove = loop.remove_writer
+            else:
+                raise psycopg2.OperationalError(f'Bad poll state: {state}.')
+            try:
+                await future
+            finally:
+                remove(fd)
+
+
+class AsyncConnection:
+    '''
+    Asynchronous counterpart of connection.Connection over a driver
+    connection (AsyncPsycopg2 or anything with the same execute(),
+    fetchone(), fetchall(), close() and closed).
+    '''
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._cursor_names = itertools.count()
+        self._depth = 0
+        self._on_commit = []
+        self.prepared = set()
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def closed(self):
+        return self.driver.closed
+
+    async def execute(self, query, params=None):
+        await self._run(query, params, query)
+
+    async def _run(self, statement, params, query):
+        if not query_stats.enabled:
+            await self.driver.execute(statement, params)
+            return
+        start = time.perf_counter()
+        await self.driver.execute(statement, params)
+        query_stats.record(query, params, time.perf_counter() - start)
+
+    def fetchone(self):
+        return self.driver.fetchone()
+
+    def fetchall(self):
+        return self.driver.fetchall()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, savepoint=False):
+        if not self._depth:
+            await self.driver.execute('BEGIN;')
+        elif savepoint:
+            name = f'savepoint_{next(self._cursor_names)}'
+            await self.driver.execute(f'SAVEPOINT {name};')
+        mark = len(self._on_commit)
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if not self._depth:
+                self._on_commit.clear()
+            elif savepoint:
+                del self._on_commit[mark:]
+            if not self.closed:
+                if not self._depth:
+                    await self.driver.execute('ROLLBACK;')
+                elif savepoint:
+                    await self.driver.execute(f'ROLLBACK TO SAVEPOINT '
+                                              f'{name};')
+            raise
+        self._depth -= 1
+        if not self._depth:
+            callbacks, self._on_commit = self._on_commit, []
+            await self.driver.execute('COMMIT;')
+            for callback in callbacks:
+                callback()
+        elif savepoint:
+            await self.driver.execute(f'RELEASE SAVEPOINT {name};')
+
+    def on_commit(self, callback):
+        '''Call callback once the outermost transaction commits.'''
+        if self._depth:
+            self._on_commit.append(callback)
+        else:
+            callback()
+
+    async def execute_prepared(self, name, query, params):
+        if name not in self.prepared:
+            logger.info(f"Preparing the SQL statement '{name}'.")
+            placeholders = tuple(f'${i}' for i in range(1, len(params) + 1))
+            await self.driver.execute(f'PREPARE {name} AS '
+                                      f'{query % placeholders}')
+            self.prepared.add(name)
+        if params:
+            values = ', '.join(['%s'] * len(params))
+            await self._run(f'EXECUTE {name} ({values});', params, query)
+        else:
+            await self._run(f'EXECUTE {name};', None, query)
+
+    async def stream(self, query, params=None, itersize=2000):
+        '''
+        Yield the rows of a query through a server-side cursor, fetching
+        itersize rows per round trip. Must run inside transaction().
+        '''
+        name = f'stream_{next(self._cursor_names)}'
+        declare = f'DECLARE {name} NO SCROLL CURSOR FOR ' \
+                  f'{query.strip().rstrip(";")};'
+        await self._run(declare, params, query)
+        try:
+            while True:
+                await self.driver.execute(f'FETCH {itersize} FROM {name};')
+                rows = self.driver.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            if not self.closed:
+                with contextlib.suppress(psycopg2.Error):
+                    await self.driver.execute(f'CLOSE {name};')
+
+    async def insert_values(self, table, fields, rows):
+        query = f'INSERT INTO {table} ({", ".join(fields)}) ' \
+                'VALUES %s RETURNING id;'
+        values = ', '.join([f'({SQLQuery.values(fields)})'] * len(rows))
+        start = time.perf_counter()
+        await self.driver.execute(query.replace('%s', values),
+                                  [val for row in rows for val in row])
+        if query_stats.enabled:
+            query_stats.record(query, None, time.perf_counter() - start)
+        return [row[0] for row in self.driver.fetchall()]
+
+    async def ping(self):
+        try:
+            await self.driver.execute('SELECT 1;')
+        except (psycopg2.Error, OSError):
+            return False
+        return True
+
+    def close(self):
+        self.driver.close()
+        logger.info("Connection closed.")
+
+
+class AsyncConnectionPool:
+    '''
+    Bounded asyncio pool of AsyncConnection objects.
+
+    A connection checked out by a task stays bound to that task until
+    the outermost checkout is returned, so nested ORM calls share it;
+    tasks spawned meanwhile get connections of their own. The driver
+    connections commit every statement sent outside BEGIN and COMMIT;
+    with autocommit=True single ORM operations are sent that way.
+    '''
+
+    def __init__(self, max_size=10, timeout=30, check_interval=60,
+                 autocommit=False, connect=AsyncPsycopg2.connect,
+                 **db_data):
+        self.db_data = db_data
+        self.connect = connect
+        self.autocommit = autocommit
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = []
+        self._size = 0
+        self._cond = asyncio.Condition()
+        self._bound = contextvars.ContextVar(f'async_pool_{id(self)}',
+                                             default=None)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        task = asyncio.current_task()
+        holder = self._bound.get()
+        if holder is None or holder[0] is None or holder[2] is not task:
+            holder = [await self._checkout(), 0, task]
+            self._bound.set(holder)
+        holder[1] += 1
+        try:
+            yield holder[0]
+        finally:
+            holder[1] -= 1
+            if not holder[1]:
+                conn, holder[0] = holder[0], None
+                await self._checkin(conn)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, savepoint=False):
+        async with self.connection() as conn, conn.transaction(savepoint):
+            yield conn
+
+    @contextlib.asynccontextmanager
+    async def operation(self):
+        '''
+        Check out a connection for one ORM operation, like
+        ConnectionPool.operation(): outside a transaction() block it runs
+        in a transaction of its own, or with autocommit=True without any.
+        '''
+        async with self.connection() as conn:
+            if self.autocommit and not conn.depth:
+                yield conn
+            else:
+                async with conn.transaction():
+                    yield conn
+
+    @contextlib.asynccontextmanager
+    async def streaming(self):
+        '''
+        Check out a connection for a server-side cursor; like
+        ConnectionPool.streaming(), outside a transaction it is not bound
+        to the task consuming the rows.
+        '''
+        holder = self._bound.get()
+        if holder is not None and holder[0] is not None and \
+           holder[2] is asyncio.current_task() and holder[0].depth:
+            async with self.transaction() as conn:
+                yield conn
+            return
+        conn = await self._checkout()
+        try:
+            async with conn.transaction():
+                yield conn
+        finally:
+            await self._checkin(conn)
+
+    async def close(self):
+        async with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+        logger.info("Connection pool closed.")
+
+    async def _checkout(self):
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(
+                    lambda: self._idle or self._size < self.max_size),
+                    self.timeout)
+            except asyncio.TimeoutError:
+                logger.error("No free connections left in the pool.")
+                raise PoolTimeout('Timed out waiting for a free '
+                                  'connection.') from None
+            if self._idle:
+                conn, released_at = self._idle.pop()
+            else:
+                conn, released_at = None, None
+                self._size += 1
+        if conn is not None and not conn.closed and (
+           time.monotonic() - released_at < self.check_interval or
+           await conn.ping()):
+            return conn
+        if conn is not None:
+            logger.info("Replacing a broken connection in the pool.")
+            conn.close()
+        try:
+            return AsyncConnection(await self.connect(**self.db_data))
+        except BaseException:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    async def _checkin(self, conn):
+        async with self._cond:
+            if conn.closed or conn.depth:
+                if not conn.closed:
+                    conn.close()
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_pool():
+    '''Return the pool shared by the async models in the running loop.'''
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = AsyncConnectionPool(**config.pool_data,
+                                                  **config.db_data)
+    return pool
+
+
+def async_transaction(savepoint=False):
+    return get_async_pool().transaction(savepoint)
+
+
+class AsyncDatabaseORM(DatabaseORM):
+    '''
+    Asynchronous variant of DatabaseORM for asyncio code.
+
+    Models declared on it share MetaORM (schema cache, statement cache,
+    indexes), field validation and row hydration with the synchronous
+    ORM; only the I/O goes through the asyncio connection pool.
+    refresh_schema(), missing_indexes() and create_missing_indexes() are
+    coroutines here, and the blocking query() and filter() are not
+    available.
+    '''
+
+    async def create(self, force=False):
+        async with get_async_pool().transaction() as conn:
+            if await self._table_exists(conn) and not force:
+                logger.error(f"Failed to create the table "
+                             f"'{self._table_name}'.")
+                raise TableExists(f'A table with name "{self._table_name}" '
+                                  'already exists.')
+            fields = ',\n'.join(f'{key} {val.sql_datatype}'
+                                for key, val in self._fields.items())
+            query = SQLQuery.create(table=self._table_name, fields=fields)
+            self.__class__.invalidate_schema()
+            await conn.execute(query)
+            for index in self._indexes:
+                await conn.execute(index.sql(self._table_name))
+        MetaORM._schema[self._table_name] = True
+        logger.info(f"Table '{self._table_name}' was created successfully.")
+
+    async def drop(self, silent=False):
+        async with get_async_pool().transaction() as conn:
+            if not await self._table_exists(conn) and not silent:
+                logger.error(f"Failed to drop the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.')
+            query = SQLQuery.drop(table=self._table_name)
+            self.__class__.invalidate_schema()
+            await conn.execute(query)
+        MetaORM._schema[self._table_name] = False
+        logger.info(f"Table '{self._table_name}' was dropped successfully.")
+
+    async def insert(self, **kwargs):
+        obj = self.__class__(**kwargs)
+        await obj.save()
+        logger.info(f"Inserted a row into the table '{self._table_name}'.")
+
+    async def insert_many(self, rows, batch_size=1000):
+        fields = list(self._fields.keys())
+        rows = iter(rows)
+        ids = []
+        async with get_async_pool().connection() as conn:
+            if not await self._table_exists(conn):
+                logger.error(f"Failed to insert rows into the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.')
+            while True:
+                batch = [self._validate_row(row)
+                         for row in itertools.islice(rows, batch_size)]
+                if not batch:
+                    break
+                async with conn.transaction():
+                    ids += await conn.insert_values(self._table_name, fields,
+                                                    batch)
+        logger.info(f"Inserted {len(ids)} rows into the table "
+                    f"'{self._table_name}'.")
+        return ids
+
+    async def save(self):
+        if self.id is not None and not self.changes():
+            logger.info(f"Nothing to save in the table '{self._table_name}'.")
+            return
+        async with get_async_pool().operation() as conn:
+            if not await self._table_exists(conn):
+                logger.error(f"Failed to save the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.')
+            try:
+                if self.id is None:
+                    fields = list(self._fields.keys())
+                    row = self._validate_row({key: getattr(self, key)
+                                              for key in fields})
+                    await self._execute(conn, 'insert',
+                                        list(zip(fields, row)))
+                    self.id = conn.fetchone()[0]
+                else:
+                    pairs = self.changes()
+                    params = [val for _, val in pairs] + [self.id]
+                    await self._execute(conn, 'update', pairs, params)
+                    if self._cache:
+                        conn.on_commit(functools.partial(
+                            row_cache.invalidate, (self._table_name,
+                                                   self.id)))
+            except psycopg2.errors.UndefinedTable as error:
+                self.__class__.invalidate_schema()
+                logger.error(f"Failed to save the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.') from error
+        self.__dict__.pop('_dirty', None)
+        logger.info(f"Table '{self._table_name}' was saved successfully.")
+
+    async def delete(self, **kwargs):
+        fields = ['id'] + list(self._fields.keys())
+        pairs = [(key, val)
+                 for key, val in kwargs.items()
+                 if key in fields]
+        async with get_async_pool().operation() as conn:
+            if pairs:
+                await self._execute(conn, 'delete', pairs)
+                if self._cache:
+                    conn.on_commit(functools.partial(
+                        row_cache.invalidate_table, self._table_name))
+            else:
+                await self._execute(conn, 'delete_id', params=[self.id])
+                if self._cache:
+                    conn.on_commit(functools.partial(
+                        row_cache.invalidate, (self._table_name, self.id)))
+        logger.info(f"Deleted rows from the table '{self._table_name}'.")
+
+    async def get(self, id=None, **kwargs):
+        fields = ['id'] + list(self._fields.keys())
+        pairs = [(key, val)
+                 for key, val in kwargs.items()
+                 if key in self._fields.keys()]
+        if id is None and not pairs:
+            logger.error(f"Method get() used instead of all() "
+                         f"for the table '{self._table_name}'.")
+            raise MethodUsageError("No valid kwargs were forwarded to get().\n"
+                                   "Try 'all' method if they're "
+                                   "not supposed to be forwarded")
+        if id is not None:
+            obj = self.__class__._lookup(id)
+            if obj is not None:
+                logger.info(f"Table '{self._table_name}' -> get() cached.")
+                return obj
+        # rows read before a concurrent invalidation are not cached
+        generation = row_cache.generation() if self._cache else None
+        async with get_async_pool().operation() as conn:
+            if id is not None:
+                await self._execute(conn, 'select_id', params=[id])
+            else:
+                await self._execute(conn, 'select_where', pairs)
+            result = conn.fetchone()
+            if self._cache and result is not None:
+                conn.on_commit(functools.partial(
+                    row_cache.set, (self._table_name, result[0]), result,
+                    generation))
+        obj = self.__class__.row_to_object(result, fields)
+        logger.info(f"Table '{self._table_name}' -> get().")
+        return self.__class__._register(obj)
+
+    async def all(self, stream=False, itersize=2000, raw=False, **kwargs):
+        fields = ['id'] + list(self._fields.keys())
+        pairs = [(key, val)
+                 for key, val in kwargs.items()
+                 if key in self._fields.keys()]
+        operation = 'select_where' if pairs else 'select'
+        if stream:
+            logger.info(f"Table '{self._table_name}' -> all(stream=True).")
+            query, _, params = self._bind(operation, pairs)
+            async with get_async_pool().streaming() as conn:
+                rows = conn.stream(query, params, itersize)
+                try:
+                    async for row in rows:
+                        for obj in self.__class__.hydrate([row], fields, raw):
+                            yield obj
+                finally:
+                    await rows.aclose()
+            return
+        async with get_async_pool().operation() as conn:
+            await self._execute(conn, operation, pairs)
+            results = conn.fetchall()
+        logger.info(f"Table '{self._table_name}' -> all().")
+        for obj in self.__class__.hydrate(results, fields, raw):
+            yield obj
+
+    def query(self):
+        logger.error(f"Method query() used on the asynchronous table "
+                     f"'{self._table_name}'.")
+        raise MethodUsageError("QuerySet runs blocking queries.\n"
+                               "Try 'all' method with kwargs instead")
+
+    def filter(self, **kwargs):
+        return self.query()
+
+    @classmethod
+    async def refresh_schema(cls, conn=None):
+        if conn is None:
+            async with get_async_pool().connection() as conn:
+                return await cls.refresh_schema(conn)
+        await conn.execute(SQLQuery.exists(), (cls._table_name,))
+        exists = bool(conn.fetchone()[0])
+        MetaORM._schema[cls._table_name] = exists
+        logger.info(f"Schema of the table '{cls._table_name}' refreshed.")
+        return exists
+
+    @classmethod
+    async def missing_indexes(cls):
+        '''Return the declared indexes that the database doesn't have.'''
+        async with get_async_pool().connection() as conn:
+            await conn.execute(SQLQuery.indexes(), (cls._table_name,))
+            existing = {row[0] for row in conn.fetchall()}
+        return [index for index in cls._indexes
+                if index.name not in existing]
+
+    @classmethod
+    async def create_missing_indexes(cls, concurrently=True):
+        '''
+        Create the declared indexes missing in the database; statements
+        outside transaction() are committed on their own, so CREATE INDEX
+        CONCURRENTLY runs as is.
+        '''
+        missing = await cls.missing_indexes()
+        async with get_async_pool().connection() as conn:
+            for index in missing:
+                query = index.sql(cls._table_name, concurrently)
+                if concurrently:
+                    await conn.execute(query)
+                else:
+                    async with conn.transaction():
+                        await conn.execute(query)
+                logger.info(f"Index '{index.name}' was created.")
+        return missing
+
+    @classmethod
+    async def _table_exists(cls, conn):
+        exists = MetaORM._schema.get(cls._table_name)
+        if exists is None:
+            exists = await cls.refresh_schema(conn)
+        return exists
+
+    @classmethod
+    async def _execute(cls, conn, operation, pairs=(), params=None):
+        query, name, params = cls._bind(operation, pairs, params)
+        if cls._prepare:
+            await conn.execute_prepared(name, query, params)
+        else:
+            await conn.execute(query, params)
@@ -0,0 +1,102 @@
+import collections
+import threading
+
+import config
+import logger
+
+
+logger = logger.get_logger(__name__)
+
+
+class RowCache:
+    '''
+    Process-wide LRU cache of table rows keyed by (table, id).
+
+    Stores the raw database rows, so every hit hydrates a fresh object
+    and objects are never shared between threads through the cache.
+
+    Invalidations are numbered. A reader takes generation() before its
+    SELECT and passes it to set(), which skips the row if its key (or
+    table) was invalidated meanwhile: the row may predate a commit whose
+    invalidation already ran. The numbers of the last max_size
+    invalidated keys are kept; an older invalidation counts as having
+    happened when the oldest kept one did.
+    '''
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows = collections.OrderedDict()
+        self._generation = 0
+        self._invalidated = collections.OrderedDict()
+        self._tables = dict()
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, key):
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return row
+
+    def generation(self):
+        '''Number of the last invalidation, to pass to set().'''
+        with self._lock:
+            return self._generation
+
+    def set(self, key, row, generation=None):
+        with self._lock:
+            if generation is not None and generation < max(
+               self._invalidated.get(key, self._floor),
+               self._tables.get(key[0], 0)):
+                return
+            self._rows[key] = row
+            self._rows.move_to_end(key)
+            if len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._rows.pop(key, None)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > self.max_size:
+                _, self._floor = self._invalidated.popitem(last=False)
+
+    def invalidate_table(self, table):
+        with self._lock:
+            for key in [key for key in self._rows if key[0] == table]:
+                del self._rows[key]
+            self._generation += 1
+            self._tables[table] = self._generation
+        logger.info(f"Cached rows of the table '{table}' invalidated.")
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._floor = self._generation
+            self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self._rows),
+            'max_size': self.max_size,
+        }
+
+
+row_cache = RowCache(**config.cache_data)
@@ -4,3 +4,32 @@ db_data = {
     'password': 'qwerty',
     'host': 'localhost',
 }
+
+pool_data = {
+    'max_size': 10,
+    'timeout': 30,
+    'check_interval': 60,
+    'autocommit': False,
+}
+
+cache_data = {
+    'max_size': 10000,
+}
+
+stats_data = {
+    'enabled': True,
+    'sample_rate': 0.01,
+    'slow_threshold': 0.5,
+    'slow_log_size': 100,
+}
+
+log_data = {
+    'directory': 'logs',
+    'queue_size': 10000,
+    'batch_size': 256,
+    'policy': 'drop',
+    'rotation': None,
+    'max_bytes': 10 * 1024 * 1024,
+    'backup_count': 5,
+    'when': 'midnight',
+}
@@ -0,0 +1,418 @@
+import asyncio
+import contextlib
+import contextvars
+import io
+import itertools
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+import config
+from instrumentation import query_stats
+import logger
+
+
+logger = logger.get_logger(__name__)
+
+
+class PoolTimeout(Exception):
+    '''No connection in the pool became free in time'''
+    pass
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return repr(value)
+
+
+class Connection:
+    '''
+    Class for connections to PostgreSQL databases.
+
+    Statements are not committed one by one: they run inside
+    transaction() blocks, and the outermost block commits. With
+    autocommit=True every statement outside such a block is committed
+    by the server on its own.
+    '''
+
+    def __init__(self, autocommit=False, connect=psycopg2.connect,
+                 **db_data):
+        logger.info("Setting the connection to database...")
+        self.db = connect(**db_data)
+        self.db.autocommit = autocommit
+        self.autocommit = autocommit
+        self.cursor = self.db.cursor()
+        self._cursor_names = itertools.count()
+        self._depth = 0
+        self._on_commit = []
+        self.prepared = set()
+        logger.info("Connection setup done.")
+
+    @property
+    def depth(self):
+        '''Number of transaction() blocks the connection is inside.'''
+        return self._depth
+
+    @contextlib.contextmanager
+    def transaction(self, savepoint=False):
+        '''
+        Run the block in a transaction. A nested block joins the outer
+        transaction, or with savepoint=True rolls back on its own to a
+        savepoint when it fails.
+        '''
+        if not self._depth:
+            self.db.autocommit = False
+        elif savepoint:
+            name = f'savepoint_{next(self._cursor_names)}'
+            self.cursor.execute(f'SAVEPOINT {name};')
+        mark = len(self._on_commit)
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if not self._depth:
+                self._on_commit.clear()
+                self.db.rollback()
+                self.db.autocommit = self.autocommit
+            elif savepoint:
+                del self._on_commit[mark:]
+                self.cursor.execute(f'ROLLBACK TO SAVEPOINT {name};')
+            raise
+        self._depth -= 1
+        if not self._depth:
+            callbacks, self._on_commit = self._on_commit, []
+            try:
+                self.db.commit()
+            finally:
+                self.db.autocommit = self.autocommit
+            for callback in callbacks:
+                callback()
+        elif savepoint:
+            self.cursor.execute(f'RELEASE SAVEPOINT {name};')
+
+    def on_commit(self, callback):
+        '''
+        Call callback once the outermost transaction() block commits, or
+        right away outside of one. The callbacks of a transaction (or a
+        savepoint) that rolls back are dropped.
+        '''
+        if self._depth:
+            self._on_commit.append(callback)
+        else:
+            callback()
+
+    def execute(self, query, params=None):
+        self._run(query, params, query)
+
+    def _run(self, statement, params, query):
+        if not query_stats.enabled:
+            self.cursor.execute(statement, params)
+            return
+        start = time.perf_counter()
+        self.cursor.execute(statement, params)
+        query_stats.record(query, params, time.perf_counter() - start)
+
+    def execute_autocommit(self, query, params=None):
+        '''Run a statement that can't run inside a transaction block.'''
+        if self._depth:
+            raise RuntimeError('The connection is inside a transaction.')
+        self.db.autocommit = True
+        try:
+            self.execute(query, params)
+        finally:
+            self.db.autocommit = self.autocommit
+
+    def execute_batch(self, statements):
+        '''Send several (query, params) statements in one round trip.'''
+        batch = b'\n'.join(self.cursor.mogrify(query, params)
+                           for query, params in statements)
+        self._run(batch, None, f'BATCH OF {len(statements)} STATEMENTS')
+
+    def execute_prepared(self, name, query, params):
+        if name not in self.prepared:
+            logger.info(f"Preparing the SQL statement '{name}'.")
+            placeholders = tuple(f'${i}' for i in range(1, len(params) + 1))
+            self.cursor.execute(f'PREPARE {name} AS {query % placeholders}')
+            self.prepared.add(name)
+        if params:
+            values = ', '.join(['%s'] * len(params))
+            self._run(f'EXECUTE {name} ({values});', params, query)
+        else:
+            self._run(f'EXECUTE {name};', None, query)
+
+    def stream(self, query, params=None, itersize=2000):
+        '''
+        Yield the rows of a query through a server-side cursor, fetching
+        itersize rows per round trip. Should be consumed inside a
+        transaction() block, which keeps the cursor alive.
+        '''
+        cursor = self.db.cursor(name=f'stream_{next(self._cursor_names)}')
+        cursor.itersize = itersize
+        try:
+            start = time.perf_counter()
+            cursor.execute(query, params)
+            if query_stats.enabled:
+                query_stats.record(query, params, time.perf_counter() - start)
+            yield from cursor
+        finally:
+            if not self.db.closed and self.db.get_transaction_status() != \
+               psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                cursor.close()
+
+    def insert_values(self, table, fields, rows):
+        query = f'INSERT INTO {table} ({", ".join(fields)}) ' \
+                'VALUES %s RETURNING id;'
+        start = time.perf_counter()
+        ids = psycopg2.extras.execute_values(self.cursor, query, rows,
+                                             page_size=len(rows),
+                                             fetch=True)
+        if query_stats.enabled:
+            query_stats.record(query, None, time.perf_counter() - start)
+        return [row[0] for row in ids]
+
+    def copy_rows(self, table, fields, rows):
+        self.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                     'FROM generate_series(1, %s);',
+                     (table, 'id', len(rows)))
+        ids = [row[0] for row in self.cursor.fetchall()]
+        data = io.StringIO()
+        for id, row in zip(ids, rows):
+            data.write(','.join(map(csv_value, (id, *row))))
+            data.write('\n')
+        data.seek(0)
+        query = f'COPY {table} (id, {", ".join(fields)}) ' \
+                'FROM STDIN WITH (FORMAT csv);'
+        start = time.perf_counter()
+        self.cursor.copy_expert(query, data)
+        if query_stats.enabled:
+            query_stats.record(query, None, time.perf_counter() - start)
+        return ids
+
+    def ping(self):
+        try:
+            self.cursor.execute('SELECT 1;')
+            if not self.autocommit:
+                self.db.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    @property
+    def closed(self):
+        return bool(self.db.closed)
+
+    def close(self):
+        self.db.close()
+        logger.info("Connection closed.")
+
+
+def _owner():
+    '''
+    The thread, and the asyncio task within it, a checked out connection
+    is bound to. Child tasks and asyncio.to_thread() workers inherit the
+    context holding the binding but must not share the connection.
+    '''
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return (threading.get_ident(), task)
+
+
+class ConnectionPool:
+    '''
+    Bounded pool of connections to a PostgreSQL database.
+
+    A connection checked out by a thread (or an asyncio task) stays bound
+    to it until the outermost checkout is returned, so nested ORM calls
+    share one connection; threads and tasks started meanwhile check out
+    their own. Idle connections are health-checked before
+    they are handed out again.
+    '''
+
+    def __init__(self, max_size=10, timeout=30, check_interval=60,
+                 autocommit=False, connect=psycopg2.connect, **db_data):
+        self.db_data = db_data
+        self.connect = connect
+        self.autocommit = autocommit
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._bound = contextvars.ContextVar(f'pool_{id(self)}',
+                                             default=None)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def acquire(self):
+        owner = _owner()
+        holder = self._bound.get()
+        if holder is not None and holder[0] is not None and \
+           holder[2] == owner:
+            holder[1] += 1
+            return holder[0]
+        holder = [self._checkout(), 1, owner]
+        self._bound.set(holder)
+        return holder[0]
+
+    def release(self, conn):
+        holder = self._bound.get()
+        if holder is None or holder[0] is not conn:
+            raise ValueError('The connection is not bound to this context.')
+        self._release(holder)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        holder = self._bound.get()
+        try:
+            yield conn
+        finally:
+            self._release(holder)
+
+    @contextlib.contextmanager
+    def transaction(self, savepoint=False):
+        with self.connection() as conn, conn.transaction(savepoint):
+            yield conn
+
+    @contextlib.contextmanager
+    def operation(self):
+        '''
+        Check out a connection for one ORM operation. Inside a
+        transaction() block it joins the transaction; outside of one it
+        runs in a transaction of its own, or with autocommit=True without
+        any, saving the BEGIN and COMMIT round trips.
+        '''
+        with self.connection() as conn:
+            if self.autocommit and not conn.depth:
+                yield conn
+            else:
+                with conn.transaction():
+                    yield conn
+
+    @contextlib.contextmanager
+    def streaming(self):
+        '''
+        Check out a connection for a server-side cursor that the caller
+        consumes while doing other work. Inside a transaction() block it
+        joins the transaction; outside of one the cursor gets a
+        transaction on a connection not bound to the caller, so the ORM
+        calls made between rows don't join it and closing the stream
+        early doesn't roll them back.
+        '''
+        holder = self._bound.get()
+        if holder is not None and holder[0] is not None and \
+           holder[2] == _owner() and holder[0].depth:
+            with self.transaction() as conn:
+                yield conn
+            return
+        conn = self._checkout()
+        try:
+            with conn.transaction():
+                yield conn
+        finally:
+            self._checkin(conn)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+        logger.info("Connection pool closed.")
+
+    def _release(self, holder):
+        holder[1] -= 1
+        if holder[1]:
+            return
+        conn, holder[0] = holder[0], None
+        self._checkin(conn)
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error("No free connections left in the pool.")
+                    raise PoolTimeout('Timed out waiting for a free '
+                                      'connection.')
+                self._cond.wait(remaining)
+            if self._idle:
+                conn, released_at = self._idle.pop()
+            else:
+                conn, released_at = None, None
+                self._size += 1
+        if conn is not None and self._is_healthy(conn, released_at):
+            return conn
+        if conn is not None:
+            logger.info("Replacing a broken connection in the pool.")
+            conn.close()
+        try:
+            return Connection(self.autocommit, self.connect, **self.db_data)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, conn):
+        if not conn.closed and conn.db.get_transaction_status() != \
+           psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.db.rollback()
+            except psycopg2.Error:
+                conn.close()
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _is_healthy(self, conn, released_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.check_interval:
+            return True
+        return conn.ping()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''Return the pool shared by all the models, creating it on first use.'''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(**config.pool_data, **config.db_data)
+    return _pool
+
+
+def transaction(savepoint=False):
+    '''
+    Check out a connection of the shared pool and run the block in one
+    transaction; ORM calls made inside the block join it.
+    '''
+    return get_pool().transaction(savepoint)
@@ -3,20 +3,47 @@ import logger
 
 logger = logger.get_logger(__name__)
 
-class Integer:
-    def __init__(self, not_null=False, non_negative=False, default=None):
+class Field:
+    '''
+    Base descriptor of table fields. Records the names of the fields
+    assigned a new value in the instance's _dirty set. With index=True
+    (or unique=True) the table gets an index on the field.
+    '''
+
+    def __init__(self, not_null=False, default=None, index=False,
+                 unique=False):
         self.not_null = not_null
-        self.non_negative = non_negative
         self.default = default
-        self.sql_datatype = 'INT' + (' NOT NULL' if not_null else '')
+        self.index = index or unique
+        self.unique = unique
 
     def __set_name__(self, owner, name):
         self.name = name
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
         return instance.__dict__[self.name]
 
     def __set__(self, instance, value):
+        value = self.validate(value)
+        values = instance.__dict__
+        if self.name not in values or values[self.name] != value:
+            values.setdefault('_dirty', set()).add(self.name)
+        values[self.name] = value
+
+    def validate(self, value):
+        return value
+
+
+class Integer(Field):
+    def __init__(self, not_null=False, non_negative=False, default=None,
+                 index=False, unique=False):
+        super().__init__(not_null, default, index, unique)
+        self.non_negative = non_negative
+        self.sql_datatype = 'INT' + (' NOT NULL' if not_null else '')
+
+    def validate(self, value):
         if value is not None:
             if not isinstance(value, int):
                 logger.error(f"Field '{self.name}' should be integer!")
@@ -24,23 +51,17 @@ class Integer:
             if self.non_negative and value < 0:
                 logger.error(f"Field '{self.name}' should be non-negative!")
                 raise ValueError('Value should be non-negative.')
-        instance.__dict__[self.name] = value
+        return value
 
 
-class Float:
-    def __init__(self, not_null=False, non_negative=False, default=None):
-        self.not_null = not_null
+class Float(Field):
+    def __init__(self, not_null=False, non_negative=False, default=None,
+                 index=False, unique=False):
+        super().__init__(not_null, default, index, unique)
         self.non_negative = non_negative
-        self.default = default
         self.sql_datatype = 'FLOAT' + (' NOT NULL' if not_null else '')
 
-    def __set_name__(self, owner, name):
-        self.name = name
-
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
-    def __set__(self, instance, value):
+    def validate(self, value):
         if value is not None:
             if not isinstance(value, float):
                 logger.error(f"Field '{self.name}' should be float!")
@@ -48,24 +69,18 @@ class Float:
             if self.non_negative and value < 0:
                 logger.error(f"Field '{self.name}' should be non-negative!")
                 raise ValueError('Value should be non-negative.')
-        instance.__dict__[self.name] = value
+        return value
 
 
-class String:
-    def __init__(self, max_len=255, not_null=False, default=None):
+class String(Field):
+    def __init__(self, max_len=255, not_null=False, default=None,
+                 index=False, unique=False):
+        super().__init__(not_null, default, index, unique)
         self.max_len = max_len
-        self.not_null = not_null
-        self.default = default
         self.sql_datatype = f'CHAR({self.max_len})' + \
                             (' NOT NULL' if not_null else '')
 
-    def __set_name__(self, owner, name):
-        self.name = name
-
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
-    def __set__(self, instance, value):
+    def validate(self, value):
         if value is not None:
             if not isinstance(value, str):
                 logger.error(f"Field '{self.name}' should be string!")
@@ -75,44 +90,32 @@ class String:
                                f"{self.max_len}!")
                 raise ValueError('Length of value cannot exceed '
                                  f'{self.max_len}.')
-        instance.__dict__[self.name] = value
+        return value
 
 
-class Text:
-    def __init__(self, not_null=False, default=None):
-        self.not_null = not_null
-        self.default = default
+class Text(Field):
+    def __init__(self, not_null=False, default=None, index=False,
+                 unique=False):
+        super().__init__(not_null, default, index, unique)
         self.sql_datatype = 'TEXT' + (' NOT NULL' if not_null else '')
 
-    def __set_name__(self, owner, name):
-        self.name = name
-
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
-    def __set__(self, instance, value):
+    def validate(self, value):
         if value is not None:
             if not isinstance(value, str):
                 logger.error(f"Field '{self.name}' should be text!")
                 raise ValueError('Value should be text.')
-        instance.__dict__[self.name] = value
+        return value
 
 
-class Bool:
-    def __init__(self, not_null=False, default=None):
-        self.not_null = not_null
-        self.default = default
+class Bool(Field):
+    def __init__(self, not_null=False, default=None, index=False,
+                 unique=False):
+        super().__init__(not_null, default, index, unique)
         self.sql_datatype = 'BOOLEAN' + (' NOT NULL' if not_null else '')
 
-    def __set_name__(self, owner, name):
-        self.name = name
-
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
-    def __set__(self, instance, value):
+    def validate(self, value):
         if value is not None:
             if not isinstance(value, bool):
                 logger.error(f"Field '{self.name}' should be boolean!")
                 raise ValueError('Value should be boolean.')
-        instance.__dict__[self.name] = value
+        return value
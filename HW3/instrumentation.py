@@ -0,0 +1,109 @@
+import bisect
+import collections
+import random
+import threading
+import time
+
+import config
+import logger
+
+
+logger = logger.get_logger(__name__)
+
+
+def compact(query):
+    return ' '.join(query.split())
+
+
+class StatementStats:
+    '''Latency histogram of one SQL statement.'''
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self, size):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * size
+
+    def percentile(self, bounds, q):
+        '''Upper bound of the bucket holding the q-th percentile.'''
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class QueryStats:
+    '''
+    Instrumentation of the SQL statements run by the connections.
+
+    Keeps a latency histogram per statement text (statements are
+    parameterized, so the text identifies the shape), logs a sample of
+    the statements and keeps the last slow statements with their
+    parameters. When disabled the connections skip it entirely.
+    '''
+
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+              0.5, 1.0, 2.5, 5.0, float('inf'))
+
+    def __init__(self, enabled=True, sample_rate=0.01, slow_threshold=0.5,
+                 slow_log_size=100):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.slow_queries = collections.deque(maxlen=slow_log_size)
+        self._statements = dict()
+        self._lock = threading.Lock()
+
+    def record(self, query, params, elapsed):
+        with self._lock:
+            stats = self._statements.get(query)
+            if stats is None:
+                stats = self._statements[query] = \
+                    StatementStats(len(self.BOUNDS))
+            stats.count += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+            stats.buckets[bisect.bisect_left(self.BOUNDS, elapsed)] += 1
+        if elapsed >= self.slow_threshold:
+            self.slow_queries.append({
+                'query': compact(query),
+                'params': params,
+                'time': elapsed,
+                'timestamp': time.time(),
+            })
+            logger.warning("Slow SQL query (%.3f s): %s, params: %r",
+                           elapsed, compact(query), params)
+        elif self.sample_rate and random.random() < self.sample_rate:
+            logger.info("SQL query (%.3f s): %.60s", elapsed, compact(query))
+
+    def snapshot(self):
+        '''Return the statistics of every statement as plain dicts.'''
+        with self._lock:
+            statements = list(self._statements.items())
+        result = dict()
+        for query, stats in statements:
+            result[compact(query)] = {
+                'count': stats.count,
+                'total': stats.total,
+                'mean': stats.total / stats.count,
+                'max': stats.max,
+                'p50': stats.percentile(self.BOUNDS, 0.5),
+                'p95': stats.percentile(self.BOUNDS, 0.95),
+                'p99': stats.percentile(self.BOUNDS, 0.99),
+                'buckets': dict(zip(self.BOUNDS, stats.buckets)),
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self.slow_queries.clear()
+
+
+query_stats = QueryStats(**config.stats_data)
@@ -1,25 +1,244 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+import config
 
 
 _log_format = f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s"
 
-def get_file_handler(name):
-    file_handler = logging.FileHandler(f"logs/{name}.log")
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _report_error(record):
+    if logging.lastResort is not None:
+        logging.lastResort.handleError(record)
+
+
+class _BatchFlush:
+    '''
+    Handler mixin letting the listener write a batch of records and flush
+    the stream once instead of after every record.
+    '''
+
+    deferred = False
+
+    def flush(self):
+        if not self.deferred:
+            super().flush()
+
+
+class FileHandler(_BatchFlush, logging.FileHandler):
+    pass
+
+
+class RotatingFileHandler(_BatchFlush, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class TimedRotatingFileHandler(_BatchFlush,
+                               logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class StreamHandler(_BatchFlush, logging.StreamHandler):
+    '''
+    Handler writing to sys.stderr as it is when the record is written,
+    not when the handler was made: test runners replace and close it.
+    '''
+
+    def __init__(self):
+        super().__init__()
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, stream):
+        pass
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler for a bounded queue. With the 'drop' policy records
+    below WARNING are dropped (and counted) while the queue is full;
+    warnings and errors, and every record with the 'block' policy, wait
+    for room in the queue instead.
+    '''
+
+    def __init__(self, queue, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f'Unknown logging queue policy "{policy}".')
+        super().__init__(queue)
+        self.policy = policy
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self.policy == 'block' or record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    '''
+    Queue listener writing the records of each logger to its own file
+    (opened lazily, on the listener thread) and to the shared handlers,
+    in batches of up to batch_size records per flush. A failing handler
+    reports through its handleError() and doesn't stop the listener.
+    '''
+
+    def __init__(self, queue, *handlers, batch_size=256, directory='logs',
+                 rotation=None, max_bytes=0, backup_count=0,
+                 when='midnight'):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.directory = directory
+        self.rotation = rotation
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.when = when
+        self.files = dict()
+
+    def handle(self, record):
+        record = self.prepare(record)
+        handlers = self.handlers
+        file_handler = self.files.get(record.name)
+        if file_handler is None:
+            try:
+                file_handler = self.files[record.name] = \
+                    self._file_handler(record.name)
+            except Exception:
+                _report_error(record)
+        if file_handler is not None:
+            handlers = (file_handler,) + handlers
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+    def _monitor(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            handlers = list(self.files.values()) + list(self.handlers)
+            for handler in handlers:
+                handler.deferred = True
+            stop = False
+            record = None
+            try:
+                for item in batch:
+                    if item is self._sentinel:
+                        stop = True
+                        continue
+                    record = item
+                    try:
+                        self.handle(record)
+                    except Exception:
+                        _report_error(record)
+            finally:
+                # a failing handler must not kill the only thread
+                # draining the queue
+                for handler in handlers:
+                    handler.deferred = False
+                    try:
+                        handler.flush()
+                    except Exception:
+                        handler.handleError(record)
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            super().stop()
+        self._thread = None
+        for handler in self.files.values():
+            handler.close()
+        self.files.clear()
+
+    def _file_handler(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        return get_file_handler(name, self.directory, self.rotation,
+                                self.max_bytes, self.backup_count, self.when)
+
+
+def get_file_handler(name, directory='logs', rotation=None, max_bytes=0,
+                     backup_count=0, when='midnight'):
+    path = os.path.join(directory, f"{name}.log")
+    if rotation == 'size':
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                           backupCount=backup_count)
+    elif rotation == 'time':
+        file_handler = TimedRotatingFileHandler(path, when=when,
+                                                backupCount=backup_count)
+    elif rotation is None:
+        file_handler = FileHandler(path)
+    else:
+        raise ValueError(f'Unknown log rotation "{rotation}".')
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(logging.Formatter(_log_format))
     return file_handler
 
 
 def get_stream_handler():
-    stream_handler = logging.StreamHandler()
+    stream_handler = StreamHandler()
     stream_handler.setLevel(logging.DEBUG)
     stream_handler.setFormatter(logging.Formatter(_log_format))
     return stream_handler
 
 
+def get_listener():
+    '''Return the running listener, starting it on first use.'''
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            log_data = dict(config.log_data)
+            log_queue = queue.Queue(log_data.pop('queue_size'))
+            log_data.pop('policy')
+            _listener = BatchQueueListener(log_queue, get_stream_handler(),
+                                           **log_data)
+            _listener.start()
+            atexit.register(stop_listener)
+        return _listener
+
+
+def stop_listener():
+    '''Write out the queued records and stop the listener thread.'''
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
 def get_logger(name):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(get_file_handler(name))
-    logger.addHandler(get_stream_handler())
+    listener = get_listener()
+    for handler in logger.handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            handler.queue = listener.queue
+            return logger
+    logger.addHandler(BoundedQueueHandler(listener.queue,
+                                          config.log_data['policy']))
     return logger
@@ -1,13 +1,24 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import itertools
 import re
 
-import psycopg2
+import psycopg2.errors
 
-import config
-from datatypes import Integer, Float, String, Text, Bool
+from cache import row_cache
+from connection import get_pool, transaction
+from datatypes import Field
 import logger
+from query import QuerySet
 
 
 logger = logger.get_logger(__name__)
+_statement_names = itertools.count()
+_session = contextvars.ContextVar('session', default=None)
+MAX_IDENTIFIER = 63
 
 def camel_to_snake_case(string):
     result = ''
@@ -22,6 +33,15 @@ def camel_to_snake_case(string):
 
 
 class SQLQuery:
+    '''
+    Templates of the SQL statements used by the ORM.
+
+    Values are never interpolated into the text: conditions and value
+    lists are rendered as %s placeholders and bound at execution time,
+    so a statement of one shape can be reused (and prepared) for any
+    values.
+    '''
+
     SELECT = '''
         SELECT {fields}
         FROM {table};
@@ -34,7 +54,7 @@ class SQLQuery:
     SELECT_ID = '''
         SELECT {fields}
         FROM {table}
-        WHERE id={id};
+        WHERE id=%s;
     '''
     DELETE = '''
         DELETE FROM {table}
@@ -42,7 +62,7 @@ class SQLQuery:
     '''
     DELETE_ID = '''
         DELETE FROM {table}
-        WHERE id={id};
+        WHERE id=%s;
     '''
     DROP = '''
         DROP TABLE IF EXISTS {table};
@@ -50,7 +70,7 @@ class SQLQuery:
     UPDATE = '''
         UPDATE {table}
         SET {conds}
-        WHERE id={id};
+        WHERE id=%s;
     '''
     INSERT = '''
         INSERT INTO {table} ({fields})
@@ -66,9 +86,18 @@ class SQLQuery:
     EXISTS = '''
         SELECT COUNT(*)
         FROM information_schema.tables
-        WHERE table_name='{table}'
+        WHERE table_name=%s
         AND table_type='BASE TABLE';
     '''
+    CREATE_INDEX = '''
+        CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name}
+        ON {table} ({fields}){where};
+    '''
+    INDEXES = '''
+        SELECT indexname
+        FROM pg_indexes
+        WHERE tablename=%s;
+    '''
 
     @classmethod
     def select(cls, **kwargs):
@@ -110,6 +139,81 @@ class SQLQuery:
     def exists(cls, **kwargs):
         return cls.EXISTS.format(**kwargs)
 
+    @classmethod
+    def create_index(cls, **kwargs):
+        return cls.CREATE_INDEX.format(**kwargs)
+
+    @classmethod
+    def indexes(cls, **kwargs):
+        return cls.INDEXES.format(**kwargs)
+
+    @staticmethod
+    def conds(keys, nulls=(), separator='\nAND '):
+        return separator.join(f'{key} IS NULL' if key in nulls
+                              else f'{key}=%s' for key in keys)
+
+    @staticmethod
+    def values(keys):
+        return ', '.join(['%s'] * len(keys))
+
+    @staticmethod
+    def statement_name(table):
+        return f'{table}_{next(_statement_names)}'
+
+
+def digest(text, size=8):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:size]
+
+
+def identifier(name, hashed=False):
+    '''
+    Cut a name to the 63 bytes PostgreSQL keeps of an identifier. With
+    hashed=True the end is replaced with a digest of the whole name, so
+    long names sharing a prefix stay distinct.
+    '''
+    raw = name.encode('utf-8')
+    if len(raw) <= MAX_IDENTIFIER:
+        return name
+    if hashed:
+        size = MAX_IDENTIFIER - 9
+        return raw[:size].decode('utf-8', 'ignore') + '_' + digest(name)
+    return raw[:MAX_IDENTIFIER].decode('utf-8', 'ignore')
+
+
+class Index:
+    '''
+    Index on one or more fields of a model table, declared in the
+    model's _indexes list. where makes it a partial index.
+    '''
+
+    def __init__(self, *fields, unique=False, where=None, name=None):
+        self.fields = fields
+        self.unique = unique
+        self.where = where
+        self.name = name
+
+    def default_name(self, table):
+        '''
+        Name of the index from its table, fields and kind; a partial index
+        gets a digest of its condition, so indexes on the same fields
+        with different conditions don't collide.
+        '''
+        parts = [table, *self.fields]
+        if self.where:
+            parts.append(digest(self.where))
+        parts.append('key' if self.unique else 'idx')
+        return identifier('_'.join(parts), hashed=True)
+
+    def sql(self, table, concurrently=False):
+        return SQLQuery.create_index(
+            unique='UNIQUE ' if self.unique else '',
+            concurrently='CONCURRENTLY ' if concurrently else '',
+            name=self.name,
+            table=table,
+            fields=', '.join(self.fields),
+            where=f'\n        WHERE {self.where}' if self.where else '',
+        )
+
 
 class TableExists(Exception):
     '''A table in a PostgreSQL database already exists'''
@@ -130,85 +234,178 @@ class NotNullFieldError(Exception):
     pass
 
 
-class Connection:
-    '''
-    Class for connections to PostgreSQL databases.
-    '''
-
-    def __init__(self, **db_data):
-        logger.info("Setting the connection to database...")
-        self.db = psycopg2.connect(**db_data)
-        self.cursor = self.db.cursor()
-        logger.info("Connection setup done.")
-
-    def execute(self, query):
-        logged_query = query.replace('\n', ' ')
-        while '  ' in logged_query:
-            logged_query = logged_query.replace('  ', ' ')
-        if len(logged_query) > 40:
-            logged_query = f"{logged_query[:40]}..."
-        logger.info(f"SQL query execution: {logged_query}")
-
-        self.cursor.execute(query)
-        self.db.commit()
-
-    def close(self):
-        self.db.close()
-        logger.info("Connection closed.")
-
-
 class MetaORM(type):
     '''
     Metaclass for PostgreSQL database ORMs.
+
+    Owns the schema metadata cache: whether a model's table exists is
+    read from information_schema once and then kept until the model
+    creates or drops the table or refresh_schema() is called.
+
+    Collects the indexes of a model from the index/unique options of its
+    fields and its _indexes list into _indexes, and builds the tuple
+    record classes used for raw results.
     '''
 
+    _schema = {}
+
     def __new__(cls, name, bases, attrs):
         attrs['_table_name'] = camel_to_snake_case(name)
         fields = dict()
         for field, value in attrs.items():
             if not field.startswith('_') and \
-               isinstance(value, (Integer, Float, String, Text, Bool)):
+               isinstance(value, Field):
                 fields[field] = value
         attrs['_fields'] = fields
+        attrs['_defaults'] = {'id': None, **{key: val.default
+                                             for key, val in fields.items()}}
+        attrs['_statements'] = dict()
+        attrs['_records'] = dict()
+        indexes = [Index(field, unique=value.unique)
+                   for field, value in fields.items() if value.index]
+        indexes += attrs.get('_indexes', [])
+        for index in indexes:
+            for field in index.fields:
+                if field != 'id' and field not in fields:
+                    logger.error(f"Index on unknown field '{field}' of the "
+                                 f"table '{attrs['_table_name']}'.")
+                    raise ValueError(f'Field "{field}" is not declared.')
+            if index.name is None:
+                index.name = index.default_name(attrs['_table_name'])
+            index.name = identifier(index.name)
+        names = [index.name for index in indexes]
+        for name in set(names):
+            if names.count(name) > 1:
+                logger.error(f"Two indexes named '{name}' on the table "
+                             f"'{attrs['_table_name']}'.")
+                raise ValueError(f'Index name "{name}" is used twice.')
+        attrs['_indexes'] = indexes
         return super().__new__(cls, name, bases, attrs)
 
+    def statement(cls, operation, keys=(), nulls=frozenset()):
+        '''
+        Return the parameterized SQL and the prepared statement name for
+        a statement shape, building it on the first request.
+        '''
+        shape = (operation, keys, nulls)
+        statement = cls._statements.get(shape)
+        if statement is None:
+            columns = ['id'] + list(cls._fields.keys())
+            separator = ',\n' if operation == 'update' else '\nAND '
+            query = getattr(SQLQuery, operation)(
+                table=cls._table_name,
+                fields=', '.join(keys if operation == 'insert' else columns),
+                conds=SQLQuery.conds(keys, nulls, separator),
+                values=SQLQuery.values(keys),
+            )
+            statement = (query, SQLQuery.statement_name(cls._table_name))
+            cls._statements[shape] = statement
+        return statement
+
+    def record(cls, fields):
+        '''
+        Return the namedtuple class for rows of the given columns: no
+        instance dict and no validation, for read-only bulk results.
+        '''
+        fields = tuple(fields)
+        record = cls._records.get(fields)
+        if record is None:
+            record = collections.namedtuple(f'{cls.__name__}Record', fields)
+            cls._records[fields] = record
+        return record
+
+    def table_exists(cls, conn):
+        exists = MetaORM._schema.get(cls._table_name)
+        if exists is None:
+            exists = cls.refresh_schema(conn)
+        return exists
+
+    def refresh_schema(cls, conn=None):
+        if conn is None:
+            with get_pool().operation() as conn:
+                return cls.refresh_schema(conn)
+        query = SQLQuery.exists()
+        conn.execute(query, (cls._table_name,))
+        exists = bool(conn.cursor.fetchone()[0])
+        MetaORM._schema[cls._table_name] = exists
+        logger.info(f"Schema of the table '{cls._table_name}' refreshed.")
+        return exists
+
+    def invalidate_schema(cls):
+        MetaORM._schema.pop(cls._table_name, None)
+
+    def missing_indexes(cls):
+        '''Return the declared indexes that the database doesn't have.'''
+        with get_pool().operation() as conn:
+            conn.execute(SQLQuery.indexes(), (cls._table_name,))
+            existing = {row[0] for row in conn.cursor.fetchall()}
+        return [index for index in cls._indexes
+                if index.name not in existing]
+
+    def create_missing_indexes(cls, concurrently=True):
+        '''
+        Create the declared indexes missing in the database, by default
+        with CREATE INDEX CONCURRENTLY so writes to the table go on.
+        '''
+        missing = cls.missing_indexes()
+        with get_pool().connection() as conn:
+            for index in missing:
+                query = index.sql(cls._table_name, concurrently)
+                if concurrently:
+                    conn.execute_autocommit(query)
+                else:
+                    with conn.transaction():
+                        conn.execute(query)
+                logger.info(f"Index '{index.name}' was created.")
+        return missing
+
 
 class DatabaseORM(metaclass=MetaORM):
     '''
     Implementation for PostgreSQL database ORM.
+
+    Set _prepare = True on a model to run its statements as server-side
+    prepared statements, and _cache = True to keep the rows it reads by
+    id in the process-wide row cache. The cache is filled and invalidated
+    only once the surrounding transaction commits.
     '''
 
+    _prepare = False
+    _cache = False
+
     def __init__(self, **kwargs):
-        self.conn = Connection(**config.db_data)
         self.id = None
         for key, val in self._fields.items():
             setattr(self, key, kwargs.get(key, val.default))
-        logger.info("Table ORM initialized.")
 
     def create(self, force=False):
-        query = SQLQuery.exists(table=self._table_name)
-        self.conn.execute(query)
-        exists = self.conn.cursor.fetchone()[0]
-        if exists and not force:
-            logger.error(f"Failed to create the table '{self._table_name}'.")
-            raise TableExists(f'A table with name "{self._table_name}" '
-                              'already exists.')
-        fields = ',\n'.join(f'{key} {val.sql_datatype}'
-                            for key, val in self._fields.items())
-        query = SQLQuery.create(table=self._table_name, fields=fields)
-        self.conn.execute(query)
+        with get_pool().transaction() as conn:
+            if self.__class__.table_exists(conn) and not force:
+                logger.error(f"Failed to create the table "
+                             f"'{self._table_name}'.")
+                raise TableExists(f'A table with name "{self._table_name}" '
+                                  'already exists.')
+            fields = ',\n'.join(f'{key} {val.sql_datatype}'
+                                for key, val in self._fields.items())
+            query = SQLQuery.create(table=self._table_name, fields=fields)
+            self.__class__.invalidate_schema()
+            conn.execute(query)
+            for index in self._indexes:
+                conn.execute(index.sql(self._table_name))
+        MetaORM._schema[self._table_name] = True
         logger.info(f"Table '{self._table_name}' was created successfully.")
 
     def drop(self, silent=False):
-        query = SQLQuery.exists(table=self._table_name)
-        self.conn.execute(query)
-        exists = self.conn.cursor.fetchone()[0]
-        if not exists and not silent:
-            logger.error(f"Failed to drop the table '{self._table_name}'.")
-            raise TableNotFound(f'A table with name "{self._table_name}" '
-                                'doesn\'t exist.')
-        query = SQLQuery.drop(table=self._table_name)
-        self.conn.execute(query)
+        with get_pool().transaction() as conn:
+            if not self.__class__.table_exists(conn) and not silent:
+                logger.error(f"Failed to drop the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.')
+            query = SQLQuery.drop(table=self._table_name)
+            self.__class__.invalidate_schema()
+            conn.execute(query)
+        MetaORM._schema[self._table_name] = False
         logger.info(f"Table '{self._table_name}' was dropped successfully.")
 
     def insert(self, **kwargs):
@@ -216,121 +413,359 @@ class DatabaseORM(metaclass=MetaORM):
         obj.save()
         logger.info(f"Inserted a row into the table '{self._table_name}'.")
 
-    def insert_many(self, rows):
-        for row in rows:
-            self.insert(**row)
+    def insert_many(self, rows, batch_size=1000, method='values'):
+        if method not in ('values', 'copy'):
+            raise ValueError('Method should be "values" or "copy".')
+        fields = list(self._fields.keys())
+        rows = map(self._validate_row, rows)
+        ids = []
+        with get_pool().connection() as conn:
+            if not self.__class__.table_exists(conn):
+                logger.error(f"Failed to insert rows into the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.')
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                with conn.transaction():
+                    if method == 'copy':
+                        ids += conn.copy_rows(self._table_name, fields, batch)
+                    else:
+                        ids += conn.insert_values(self._table_name, fields,
+                                                  batch)
+        logger.info(f"Inserted {len(ids)} rows into the table "
+                    f"'{self._table_name}'.")
+        return ids
 
     def save(self):
-        query = SQLQuery.exists(table=self._table_name)
-        self.conn.execute(query)
-        exists = self.conn.cursor.fetchone()[0]
-        if not exists:
-            logger.error(f"Failed to save the table '{self._table_name}'.")
-            raise TableNotFound(f'A table with name "{self._table_name}" '
-                                'doesn\'t exist.')
-        if self.id is None:
-            self._save()
-        else:
-            self._update()
+        if self.id is not None and not self.changes():
+            logger.info(f"Nothing to save in the table '{self._table_name}'.")
+            return
+        with get_pool().operation() as conn:
+            if not self.__class__.table_exists(conn):
+                logger.error(f"Failed to save the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.')
+            try:
+                if self.id is None:
+                    self._save(conn)
+                else:
+                    self._update(conn)
+            except psycopg2.errors.UndefinedTable as error:
+                self.__class__.invalidate_schema()
+                logger.error(f"Failed to save the table "
+                             f"'{self._table_name}'.")
+                raise TableNotFound(f'A table with name "{self._table_name}" '
+                                    'doesn\'t exist.') from error
         logger.info(f"Table '{self._table_name}' was saved successfully.")
 
     def delete(self, **kwargs):
         fields = ['id'] + list(self._fields.keys())
-        conds = '\nAND '.join(f'{key}={"NULL" if val is None else repr(val)}'
-                              for key, val in kwargs.items()
-                              if key in fields)
-        if conds:
-            query = SQLQuery.delete(table=self._table_name, conds=conds)
-        else:
-            query = SQLQuery.delete_id(table=self._table_name, id=self.id)
-        self.conn.execute(query)
+        pairs = [(key, val)
+                 for key, val in kwargs.items()
+                 if key in fields]
+        with get_pool().operation() as conn:
+            if pairs:
+                self._execute(conn, 'delete', pairs)
+                if self._cache:
+                    conn.on_commit(functools.partial(
+                        row_cache.invalidate_table, self._table_name))
+            else:
+                self._execute(conn, 'delete_id', params=[self.id])
+                if self._cache:
+                    conn.on_commit(functools.partial(
+                        row_cache.invalidate, (self._table_name, self.id)))
+        session = _session.get()
+        if session is not None:
+            if pairs:
+                session.forget(self.__class__)
+            else:
+                session.identity.pop((self._table_name, self.id), None)
         logger.info(f"Deleted rows from the table '{self._table_name}'.")
 
-    def _save(self):
-        fields = list(self._fields.keys())
-        reprs = []
-        for key in fields:
-            val = getattr(self, key)
-            if self._fields[key].not_null and val is None:
+    @classmethod
+    def _bind(cls, operation, pairs=(), params=None):
+        keys = tuple(key for key, _ in pairs)
+        nulls = frozenset()
+        if operation in ('select_where', 'delete'):
+            nulls = frozenset(key for key, val in pairs if val is None)
+        if params is None:
+            params = [val for key, val in pairs if key not in nulls]
+        query, name = cls.statement(operation, keys, nulls)
+        return query, name, params
+
+    @classmethod
+    def _execute(cls, conn, operation, pairs=(), params=None):
+        query, name, params = cls._bind(operation, pairs, params)
+        if cls._prepare:
+            conn.execute_prepared(name, query, params)
+        else:
+            conn.execute(query, params)
+
+    @classmethod
+    def _validate_row(cls, row):
+        values = []
+        for key, field in cls._fields.items():
+            val = field.validate(row.get(key, field.default))
+            if field.not_null and val is None:
                 logger.error(f"Attempted to save a row into the table "
-                             f"'{self._table_name}' with None values for "
+                             f"'{cls._table_name}' with None values for "
                              "keys which are \"NOT NULL\".")
                 raise NotNullFieldError(f'The field "{key}" is not nullable.')
-            reprs.append("NULL" if val is None else repr(val))
-        values = ', '.join(reprs)
-        query = SQLQuery.insert(table=self._table_name,
-                                fields=', '.join(fields),
-                                values=values)
-        self.conn.execute(query)
-        self.id = self.conn.cursor.fetchone()[0]
-
-    def _update(self):
-        conds = ',\n'.join(f'{key}={"NULL" if val is None else repr(val)}'
-                           for key, val in self._fields.items())
-        query = SQLQuery.update(table=self._table_name,
-                                conds=conds,
-                                id=self.id)
-        self.conn.execute(query)
+            values.append(val)
+        return tuple(values)
+
+    def _save(self, conn):
+        fields = list(self._fields.keys())
+        row = self._validate_row({key: getattr(self, key) for key in fields})
+        self._execute(conn, 'insert', list(zip(fields, row)))
+        self.id = conn.cursor.fetchone()[0]
+        self.__dict__.pop('_dirty', None)
+
+    def _update(self, conn):
+        pairs = self.changes()
+        params = [val for _, val in pairs] + [self.id]
+        self._execute(conn, 'update', pairs, params)
+        self.__dict__.pop('_dirty', None)
+        if self._cache:
+            conn.on_commit(functools.partial(
+                row_cache.invalidate, (self._table_name, self.id)))
+
+    def changes(self):
+        '''Return (field, value) pairs of the fields modified since load.'''
+        dirty = self.__dict__.get('_dirty', ())
+        return [(key, getattr(self, key))
+                for key in self._fields if key in dirty]
 
     def get(self, id=None, **kwargs):
+        fields = ['id'] + list(self._fields.keys())
+        pairs = [(key, val)
+                 for key, val in kwargs.items()
+                 if key in self._fields.keys()]
+        if id is None and not pairs:
+            logger.error(f"Method get() used instead of all() "
+                         f"for the table '{self._table_name}'.")
+            raise MethodUsageError("No valid kwargs were forwarded to get().\n"
+                                   "Try 'all' method if they're "
+                                   "not supposed to be forwarded")
         if id is not None:
-            fields = list(self._fields.keys())
-            query = SQLQuery.select_id(table=self._table_name,
-                                       fields=', '.join(fields),
-                                       id=self.id)
-        else:
-            fields = ['id'] + list(self._fields.keys())
-            pairs = [(key, val)
-                     for key, val in kwargs.items()
-                     if key in self._fields.keys()]
-            if not pairs:
-                logger.error(f"Method get() used instead of all() "
-                             f"for the table '{self._table_name}'.")
-                raise MethodUsageError("No valid kwargs were forwarded to get().\n"
-                                       "Try 'all' method if they're "
-                                       "not supposed to be forwarded")
-            conds = '\nAND '.join(f'{key}={"NULL" if val is None else repr(val)}'
-                                  for key, val in pairs)
-            query = SQLQuery.select_where(table=self._table_name,
-                                          fields=', '.join(fields),
-                                          conds=conds)
-        self.conn.execute(query)
-        result = self.conn.cursor.fetchone()
+            obj = self.__class__._lookup(id)
+            if obj is not None:
+                logger.info(f"Table '{self._table_name}' -> get() cached.")
+                return obj
+        # rows read before a concurrent invalidation are not cached
+        generation = row_cache.generation() if self._cache else None
+        with get_pool().operation() as conn:
+            if id is not None:
+                self._execute(conn, 'select_id', params=[id])
+            else:
+                self._execute(conn, 'select_where', pairs)
+            result = conn.cursor.fetchone()
+            if self._cache and result is not None:
+                conn.on_commit(functools.partial(
+                    row_cache.set, (self._table_name, result[0]), result,
+                    generation))
         obj = self.__class__.row_to_object(result, fields)
-        if obj is not None:
-            obj.id = id
         logger.info(f"Table '{self._table_name}' -> get().")
-        return obj
+        return self.__class__._register(obj)
+
+    @classmethod
+    def _lookup(cls, id):
+        session = _session.get()
+        if session is not None:
+            obj = session.identity.get((cls._table_name, id))
+            if obj is not None:
+                return obj
+        if cls._cache:
+            row = row_cache.get((cls._table_name, id))
+            if row is not None:
+                fields = ['id'] + list(cls._fields.keys())
+                return cls._register(cls.row_to_object(row, fields))
 
-    def all(self, **kwargs):
+    @classmethod
+    def _register(cls, obj):
+        session = _session.get()
+        if session is None or obj is None:
+            return obj
+        return session.identity.setdefault((cls._table_name, obj.id), obj)
+
+    def all(self, stream=False, itersize=2000, raw=False, **kwargs):
         fields = ['id'] + list(self._fields.keys())
-        if kwargs:
-            pairs = [(key, val)
-                     for key, val in kwargs.items()
-                     if key in self._fields.keys()]
-            conds = '\nAND '.join(f'{key}={"NULL" if val is None else repr(val)}'
-                                  for key, val in pairs)
-            query = SQLQuery.select_where(table=self._table_name,
-                                          fields=', '.join(fields),
-                                          conds=conds)
-        else:
-            query = SQLQuery.select(table=self._table_name,
-                                    fields=', '.join(fields))
-        self.conn.execute(query)
-        results = self.conn.cursor.fetchall()
+        pairs = [(key, val)
+                 for key, val in kwargs.items()
+                 if key in self._fields.keys()]
+        operation = 'select_where' if pairs else 'select'
+        if stream:
+            logger.info(f"Table '{self._table_name}' -> all(stream=True).")
+            query, _, params = self._bind(operation, pairs)
+            with get_pool().streaming() as conn, \
+                 contextlib.closing(conn.stream(query, params,
+                                                itersize)) as rows:
+                yield from self.__class__.hydrate(rows, fields, raw)
+            return
+        with get_pool().operation() as conn:
+            self._execute(conn, operation, pairs)
+            results = conn.cursor.fetchall()
         logger.info(f"Table '{self._table_name}' -> all().")
-        for row in results:
-            obj = self.__class__.row_to_object(row, fields)
-            yield obj
+        yield from self.__class__.hydrate(results, fields, raw)
+
+    def query(self):
+        return QuerySet(self.__class__)
+
+    def filter(self, **kwargs):
+        return QuerySet(self.__class__).filter(**kwargs)
 
     @classmethod
     def row_to_object(cls, row, fields):
+        '''
+        Build an object from a database row. The row is trusted, so the
+        values are stored without __init__ and descriptor validation.
+        '''
         if row is not None:
-            obj = cls()
-            for i, field in enumerate(row):
-                setattr(obj, fields[i], field)
+            obj = cls.__new__(cls)
+            values = obj.__dict__
+            values.update(cls._defaults)
+            values.update(zip(fields, row))
             return obj
 
+    @classmethod
+    def hydrate(cls, rows, fields, raw=False):
+        '''
+        Yield objects for rows, or with raw=True the rows as records of
+        cls.record(fields). Objects missing some of the columns are not
+        registered in the session's identity map, where later get()
+        calls would return them.
+        '''
+        if raw:
+            yield from map(cls.record(fields)._make, rows)
+            return
+        if not cls._defaults.keys() <= set(fields):
+            yield from (cls.row_to_object(row, fields) for row in rows)
+            return
+        for row in rows:
+            yield cls._register(cls.row_to_object(row, fields))
+
     def pretty_repr(self):
         return '\n'.join(f'{key}: {getattr(self, key)}'
                          for key in self._fields)
+
+
+class Session:
+    '''
+    Unit of work for DatabaseORM objects.
+
+    Collects new, modified and deleted objects and writes them in one
+    transaction on commit(): the INSERTs of each model go as one
+    multi-row statement, all the UPDATEs and DELETEs as one batch.
+
+    While the session is entered as a context manager it is also the
+    identity map of the current thread/task: get() and all() return the
+    object already loaded for a (table, id) instead of a new copy.
+    '''
+
+    def __init__(self):
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+        self.identity = dict()
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_session.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _session.reset(self._tokens.pop())
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def add(self, obj):
+        if obj.id is None:
+            if all(item is not obj for item in self.new):
+                self.new.append(obj)
+            return
+        self.identity[(obj._table_name, obj.id)] = obj
+        if all(item is not obj for item in self.dirty):
+            self.dirty.append(obj)
+
+    def delete(self, obj):
+        if obj.id is None:
+            self.new = [item for item in self.new if item is not obj]
+            return
+        self.dirty = [item for item in self.dirty if item is not obj]
+        self.identity.pop((obj._table_name, obj.id), None)
+        if all(item is not obj for item in self.deleted):
+            self.deleted.append(obj)
+
+    def forget(self, model):
+        self.identity = {key: obj for key, obj in self.identity.items()
+                         if key[0] != model._table_name}
+
+    def commit(self):
+        try:
+            with transaction() as conn:
+                self._insert(conn)
+                statements = []
+                for obj in self.dirty:
+                    pairs = obj.changes()
+                    if not pairs:
+                        continue
+                    params = [val for _, val in pairs] + [obj.id]
+                    query, _, params = obj._bind('update', pairs, params)
+                    statements.append((query, params))
+                for obj in self.deleted:
+                    query, _, params = obj._bind('delete_id',
+                                                 params=[obj.id])
+                    statements.append((query, params))
+                if statements:
+                    conn.execute_batch(statements)
+                for obj in self.dirty + self.deleted:
+                    if obj._cache:
+                        conn.on_commit(functools.partial(
+                            row_cache.invalidate, (obj._table_name, obj.id)))
+        except BaseException:
+            # the rows inserted by _insert() were rolled back
+            for obj in self.new:
+                obj.id = None
+            raise
+        for obj in self.new + self.dirty:
+            obj.__dict__.pop('_dirty', None)
+            self.identity[(obj._table_name, obj.id)] = obj
+        for obj in self.deleted:
+            obj.id = None
+        logger.info(f"Session committed: {len(self.new)} inserted, "
+                    f"{len(self.dirty)} updated, "
+                    f"{len(self.deleted)} deleted.")
+        self._reset()
+
+    def rollback(self):
+        self._reset()
+        self.identity.clear()
+
+    def _reset(self):
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+
+    def _insert(self, conn):
+        models = dict()
+        for obj in self.new:
+            models.setdefault(obj.__class__, []).append(obj)
+        for model, objs in models.items():
+            if not model.table_exists(conn):
+                logger.error(f"Failed to save the table "
+                             f"'{model._table_name}'.")
+                raise TableNotFound(f'A table with name "{model._table_name}" '
+                                    'doesn\'t exist.')
+            rows = [model._validate_row({key: getattr(obj, key)
+                                         for key in model._fields})
+                    for obj in objs]
+            ids = conn.insert_values(model._table_name, list(model._fields),
+                                     rows)
+            for obj, id in zip(objs, ids):
+                obj.id = id
@@ -0,0 +1,216 @@
+import contextlib
+
+from connection import get_pool
+import logger
+
+
+logger = logger.get_logger(__name__)
+
+LOOKUPS = {
+    'eq': '{} = %s',
+    'ne': '{} <> %s',
+    'lt': '{} < %s',
+    'lte': '{} <= %s',
+    'gt': '{} > %s',
+    'gte': '{} >= %s',
+    'in': '{} IN %s',
+}
+
+
+class QuerySet:
+    '''
+    Lazily evaluated query over the table of a DatabaseORM model.
+
+    filter(), order_by(), limit(), offset(), only(), raw() and after()
+    return new query sets; nothing runs until the query set is iterated or
+    count(), exists() or first() are called. Filters take Django-like
+    keys: age__gte=18, name__in=['a', 'b'], bio__isnull=True.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self._where = ()
+        self._order = ()
+        self._limit = None
+        self._offset = None
+        self._only = None
+        self._raw = False
+        self._result = None
+
+    def __iter__(self):
+        if self._result is None:
+            self._result = self._fetch()
+        return iter(self._result)
+
+    def __len__(self):
+        if self._result is None:
+            self._result = self._fetch()
+        return len(self._result)
+
+    def __repr__(self):
+        return f'<QuerySet {self.sql()}>'
+
+    def filter(self, **kwargs):
+        where = list(self._where)
+        for key, val in kwargs.items():
+            name, _, lookup = key.partition('__')
+            self._check_field(name)
+            where.append(self._condition(name, lookup or 'eq', val))
+        return self._clone(_where=tuple(where))
+
+    def order_by(self, *fields):
+        order = []
+        for field in fields:
+            name = field.lstrip('-')
+            self._check_field(name)
+            order.append((name, field.startswith('-')))
+        return self._clone(_order=tuple(order))
+
+    def limit(self, limit):
+        return self._clone(_limit=limit)
+
+    def offset(self, offset):
+        return self._clone(_offset=offset)
+
+    def only(self, *fields):
+        for name in fields:
+            self._check_field(name)
+        return self._clone(_only=tuple(name for name in fields
+                                       if name != 'id'))
+
+    def raw(self):
+        '''Return rows as namedtuple records instead of model objects.'''
+        return self._clone(_raw=True)
+
+    def after(self, **values):
+        '''
+        Keyset pagination: keep the rows that come after the given values
+        of the order_by() fields, e.g. .order_by('age', 'id')
+        .after(age=30, id=12).
+        '''
+        names = [name for name, _ in self._order]
+        if not names or sorted(names) != sorted(values):
+            raise ValueError('after() needs a value for each order_by() '
+                             'field.')
+        directions = {desc for _, desc in self._order}
+        if len(directions) > 1:
+            raise ValueError('after() needs all order_by() fields sorted '
+                             'in one direction.')
+        operator = '<' if directions.pop() else '>'
+        cond = f'({", ".join(names)}) {operator} ' \
+               f'({", ".join(["%s"] * len(names))})'
+        params = tuple(values[name] for name in names)
+        return self._clone(_where=self._where + ((cond, params),))
+
+    def pages(self, size):
+        '''Yield lists of up to size objects, paging with after().'''
+        query = self
+        if 'id' not in (name for name, _ in self._order):
+            desc = self._order[-1][1] if self._order else False
+            query = self._clone(_order=self._order + (('id', desc),))
+        query = query.limit(size)
+        page = query
+        while True:
+            objs = list(page)
+            if objs:
+                yield objs
+            if len(objs) < size:
+                return
+            last = objs[-1]
+            page = query.after(**{name: getattr(last, name)
+                                  for name, _ in query._order})
+
+    def first(self):
+        for obj in self.limit(1):
+            return obj
+
+    def count(self):
+        query, params = self.sql('1')
+        query = f'SELECT COUNT(*) FROM ({query}) AS query;'
+        with get_pool().operation() as conn:
+            conn.execute(query, params)
+            count = conn.cursor.fetchone()[0]
+        logger.info(f"Table '{self.model._table_name}' -> count().")
+        return count
+
+    def exists(self):
+        query, params = self.limit(1).sql('1')
+        query = f'SELECT EXISTS ({query});'
+        with get_pool().operation() as conn:
+            conn.execute(query, params)
+            exists = conn.cursor.fetchone()[0]
+        logger.info(f"Table '{self.model._table_name}' -> exists().")
+        return exists
+
+    def iterator(self, itersize=2000):
+        '''Stream the objects through a server-side cursor.'''
+        query, params = self.sql()
+        fields = self._columns()
+        with get_pool().streaming() as conn, \
+             contextlib.closing(conn.stream(query, params, itersize)) as rows:
+            yield from self.model.hydrate(rows, fields, self._raw)
+
+    def sql(self, columns=None):
+        '''Return the SELECT statement of the query set and its params.'''
+        if columns is None:
+            columns = ', '.join(self._columns())
+        query = f'SELECT {columns} FROM {self.model._table_name}'
+        params = []
+        if self._where:
+            query += ' WHERE ' + ' AND '.join(cond for cond, _ in self._where)
+            for _, cond_params in self._where:
+                params.extend(cond_params)
+        if self._order:
+            query += ' ORDER BY ' + ', '.join(
+                f'{name} DESC' if desc else name
+                for name, desc in self._order)
+        if self._limit is not None:
+            query += ' LIMIT %s'
+            params.append(self._limit)
+        if self._offset is not None:
+            query += ' OFFSET %s'
+            params.append(self._offset)
+        return query, params
+
+    def _fetch(self):
+        query, params = self.sql()
+        with get_pool().operation() as conn:
+            conn.execute(query, params)
+            rows = conn.cursor.fetchall()
+        logger.info(f"Table '{self.model._table_name}' -> query().")
+        return list(self.model.hydrate(rows, self._columns(), self._raw))
+
+    def _columns(self):
+        if not self._only:
+            return ['id'] + list(self.model._fields)
+        # pages() reads the order_by() values of the last row
+        ordered = [name for name, _ in self._order
+                   if name != 'id' and name not in self._only]
+        return ['id', *self._only, *ordered]
+
+    def _clone(self, **changes):
+        queryset = QuerySet.__new__(QuerySet)
+        queryset.__dict__.update(self.__dict__)
+        queryset.__dict__.update(changes)
+        queryset._result = None
+        return queryset
+
+    def _check_field(self, name):
+        if name != 'id' and name not in self.model._fields:
+            logger.error(f"Unknown field '{name}' in a query to the table "
+                         f"'{self.model._table_name}'.")
+            raise ValueError(f'The table "{self.model._table_name}" has no '
+                             f'field "{name}".')
+
+    def _condition(self, name, lookup, val):
+        if lookup == 'isnull':
+            return (f'{name} IS {"" if val else "NOT "}NULL', ())
+        if val is None and lookup in ('eq', 'ne'):
+            return (f'{name} IS {"NOT " if lookup == "ne" else ""}NULL', ())
+        if lookup == 'in':
+            val = tuple(val)
+            if not val:
+                return ('FALSE', ())
+        if lookup not in LOOKUPS:
+            raise ValueError(f'Unknown lookup "{lookup}".')
+        return (LOOKUPS[lookup].format(name), (val,))
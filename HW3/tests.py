@@ -0,0 +1,816 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import io
+import logging
+import queue
+import tempfile
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+import async_orm
+from async_orm import AsyncConnectionPool, AsyncDatabaseORM
+from cache import RowCache, row_cache
+import connection
+from connection import ConnectionPool, PoolTimeout
+from datatypes import Integer, String
+from instrumentation import QueryStats
+import logger
+from orm import DatabaseORM, Index, MetaORM, MethodUsageError, Session
+
+
+class FakeDriver:
+    '''Driver connection answering queries with canned rows.'''
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.queries = []
+        self.rows = []
+        self.closed = False
+
+    async def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        self.queries.append((query, params))
+        self.rows = list(self.respond(query, params))
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+def literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+class FakeCursor:
+    '''psycopg2 cursor of a FakeDB.'''
+
+    def __init__(self, db, name=None):
+        self.db = db
+        self.name = name
+        self.connection = db
+        self.itersize = 2000
+        self.rows = []
+
+    def execute(self, query, params=None):
+        if isinstance(query, bytes):
+            query = query.decode()
+        query = ' '.join(query.split())
+        if not self.db.autocommit and not self.db.in_transaction:
+            self.db.in_transaction = True
+            self.db.queries.append(('BEGIN;', None))
+        self.db.queries.append((query, params))
+        self.rows = list(self.db.respond(query, params))
+
+    def mogrify(self, query, params=None):
+        if isinstance(query, bytes):
+            query = query.decode()
+        query = ' '.join(query.split())
+        return (query % tuple(map(literal, params or ()))).encode()
+
+    def copy_expert(self, query, data):
+        self.execute(query, data.read())
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    '''psycopg2 connection answering queries with canned rows.'''
+
+    encoding = 'UTF8'
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.queries = []
+        self.autocommit = False
+        self.in_transaction = False
+        self.closed = 0
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        self._end('COMMIT;')
+
+    def rollback(self):
+        self._end('ROLLBACK;')
+
+    def _end(self, query):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.queries.append((query, None))
+
+    def get_transaction_status(self):
+        if self.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class SyncTestCase(unittest.TestCase):
+    '''Runs the synchronous ORM on a pool of FakeDB connections.'''
+
+    def setUp(self):
+        self.dbs = []
+        self.respond = lambda query, params: []
+        row_cache.clear()
+        previous = connection._pool
+        self.addCleanup(setattr, connection, '_pool', previous)
+        connection._pool = self.make_pool()
+
+    def make_pool(self, **pool_data):
+        def connect(**db_data):
+            db = FakeDB(lambda query, params: self.respond(query, params))
+            self.dbs.append(db)
+            return db
+
+        return ConnectionPool(connect=connect, **pool_data)
+
+    def queries(self):
+        return [query for db in self.dbs for query, _ in db.queries]
+
+    def params(self):
+        return [params for db in self.dbs for _, params in db.queries]
+
+
+class TestConnectionPool(SyncTestCase):
+
+    def test_nested_checkouts_share_connection(self):
+        pool = connection.get_pool()
+        with pool.connection() as conn:
+            self.assertIs(pool.acquire(), conn)
+            pool.release(conn)
+        self.assertEqual((pool.size, pool.idle), (1, 1))
+
+    def test_threads_do_not_share_connection(self):
+        pool = connection.get_pool()
+        with pool.connection() as conn:
+            context = contextvars.copy_context()
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                other = executor.submit(context.run, pool.acquire).result()
+            self.assertIsNot(other, conn)
+
+    def test_tasks_do_not_share_connection(self):
+        pool = connection.get_pool()
+
+        async def main():
+            with pool.connection() as conn:
+                child = await asyncio.create_task(
+                    asyncio.to_thread(pool.acquire))
+                return conn, child
+
+        conn, child = asyncio.run(main())
+        self.assertIsNot(child, conn)
+
+    def test_timeout(self):
+        pool = self.make_pool(max_size=1, timeout=0.01)
+        pool.acquire()
+        context = contextvars.copy_context()
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            with self.assertRaises(PoolTimeout):
+                executor.submit(context.run, pool.acquire).result()
+
+
+class Member(DatabaseORM):
+    name = String(20, not_null=True)
+    age = Integer()
+
+
+class TestTransactions(SyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        MetaORM._schema['member'] = True
+
+    def test_operation_in_transaction(self):
+        Member().get(id=1)
+        self.assertEqual(self.queries(), [
+            'BEGIN;',
+            'SELECT id, name, age FROM member WHERE id=%s;',
+            'COMMIT;',
+        ])
+
+    def test_autocommit_skips_transaction(self):
+        connection._pool = self.make_pool(autocommit=True)
+        Member().get(id=1)
+        self.assertEqual(self.queries(),
+                         ['SELECT id, name, age FROM member WHERE id=%s;'])
+        with connection.transaction():
+            Member().get(id=1)
+            Member().get(id=2)
+        self.assertEqual([query.split()[0] for query in self.queries()[1:]],
+                         ['BEGIN;', 'SELECT', 'SELECT', 'COMMIT;'])
+
+    def test_savepoint(self):
+        with connection.transaction():
+            with self.assertRaises(KeyError):
+                with connection.transaction(savepoint=True):
+                    raise KeyError
+        self.assertEqual(self.queries(), [
+            'BEGIN;',
+            'SAVEPOINT savepoint_0;',
+            'ROLLBACK TO SAVEPOINT savepoint_0;',
+            'COMMIT;',
+        ])
+
+    def test_session_failure_resets_ids(self):
+        def respond(query, params):
+            if query.startswith('INSERT'):
+                return [(7,)]
+            if 'DELETE' in query:
+                raise psycopg2.Error('failed')
+            return []
+
+        self.respond = respond
+        new = Member(name='Walter')
+        old = Member.row_to_object((3, 'Jesse', 25), ['id', 'name', 'age'])
+        session = Session()
+        session.add(new)
+        session.delete(old)
+        with self.assertRaises(psycopg2.Error):
+            session.commit()
+        self.assertIsNone(new.id)
+        self.assertEqual(self.queries()[-1], 'ROLLBACK;')
+
+
+class PreparedMember(DatabaseORM):
+    _prepare = True
+    name = String(20, not_null=True)
+    age = Integer()
+
+
+class TestORM(SyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        MetaORM._schema['member'] = True
+        MetaORM._schema['prepared_member'] = True
+        self.respond = lambda query, params: \
+            [(1, 'Jesse', 25)] if query.startswith('SELECT id') else []
+
+    def test_insert_many_values(self):
+        self.respond = lambda query, params: [(1,), (2,)]
+        ids = Member().insert_many([{'name': 'a', 'age': 1},
+                                    {'name': 'b'}])
+        self.assertEqual(ids, [1, 2])
+        self.assertEqual(self.queries(), [
+            'BEGIN;',
+            "INSERT INTO member (name, age) VALUES ('a',1),('b',NULL) "
+            "RETURNING id;",
+            'COMMIT;',
+        ])
+
+    def test_insert_many_copy(self):
+        self.respond = lambda query, params: \
+            [(10,), (11,)] if query.startswith('SELECT nextval') else []
+        ids = Member().insert_many([{'name': 'a', 'age': 1},
+                                    {'name': 'b'}], method='copy')
+        self.assertEqual(ids, [10, 11])
+        self.assertEqual(self.queries()[2],
+                         'COPY member (id, name, age) FROM STDIN WITH '
+                         '(FORMAT csv);')
+        self.assertEqual(self.params()[1], ('member', 'id', 2))
+        self.assertEqual(self.params()[2], '10,"a",1\n11,"b",\n')
+
+    def test_insert_many_batches(self):
+        self.respond = lambda query, params: [(1,)]
+        Member().insert_many([{'name': 'a'}] * 3, batch_size=2)
+        self.assertEqual([query.split()[0] for query in self.queries()],
+                         ['BEGIN;', 'INSERT', 'COMMIT;'] * 2)
+
+    def test_schema_cache(self):
+        MetaORM._schema.pop('member')
+        self.respond = lambda query, params: [(1,)]
+        Member().insert_many([{'name': 'a'}])
+        Member().insert_many([{'name': 'b'}])
+        exists = [query for query in self.queries()
+                  if 'information_schema' in query]
+        self.assertEqual(len(exists), 1)
+        Member().drop()
+        self.assertIs(MetaORM._schema['member'], False)
+
+    def test_stream(self):
+        objs = list(Member().all(stream=True, itersize=10))
+        self.assertEqual([(obj.id, obj.name) for obj in objs],
+                         [(1, 'Jesse')])
+        self.assertEqual(self.queries(), [
+            'BEGIN;', 'SELECT id, name, age FROM member;', 'COMMIT;'])
+
+    def test_stream_closed_after_save(self):
+        with contextlib.closing(Member().all(stream=True)) as people:
+            for person in people:
+                person.name = 'Walter'
+                person.save()
+                break
+        stream, save = ([query for query, _ in db.queries]
+                        for db in self.dbs)
+        self.assertEqual(stream, [
+            'BEGIN;', 'SELECT id, name, age FROM member;', 'ROLLBACK;'])
+        self.assertEqual(save, [
+            'BEGIN;', 'UPDATE member SET name=%s WHERE id=%s;', 'COMMIT;'])
+
+    def test_stream_joins_transaction(self):
+        with connection.transaction():
+            list(Member().all(stream=True))
+        self.assertEqual(self.queries(), [
+            'BEGIN;', 'SELECT id, name, age FROM member;', 'COMMIT;'])
+
+    def test_raw(self):
+        record, = Member().all(raw=True)
+        self.assertEqual(record._fields, ('id', 'name', 'age'))
+        self.assertEqual(record, (1, 'Jesse', 25))
+
+    def test_statement_cache(self):
+        first = Member.statement('select_where', ('name',), frozenset())
+        second = Member.statement('select_where', ('name',), frozenset())
+        self.assertIs(first, second)
+        list(Member().all(name='a'))
+        list(Member().all(name=None))
+        self.assertEqual(self.queries()[1],
+                         'SELECT id, name, age FROM member WHERE name=%s;')
+        self.assertEqual(self.queries()[4],
+                         'SELECT id, name, age FROM member WHERE name IS '
+                         'NULL;')
+        self.assertEqual(self.params()[4], [])
+
+    def test_prepared(self):
+        PreparedMember().get(id=1)
+        PreparedMember().get(id=2)
+        queries = [query for query in self.queries()
+                   if query.split()[0] in ('PREPARE', 'EXECUTE')]
+        name = queries[0].split()[1]
+        self.assertEqual(queries, [
+            f'PREPARE {name} AS SELECT id, name, age FROM prepared_member '
+            'WHERE id=$1;',
+            f'EXECUTE {name} (%s);',
+            f'EXECUTE {name} (%s);',
+        ])
+
+    def test_save_unchanged(self):
+        person = Member().get(id=1)
+        count = len(self.queries())
+        person.save()
+        self.assertEqual(len(self.queries()), count)
+
+    def test_save_changed_fields(self):
+        person = Member().get(id=1)
+        person.age = 26
+        person.save()
+        self.assertEqual(self.queries()[-2],
+                         'UPDATE member SET age=%s WHERE id=%s;')
+        self.assertEqual(self.params()[-2], [26, 1])
+        count = len(self.queries())
+        person.save()
+        self.assertEqual(len(self.queries()), count)
+
+    def test_identity_map(self):
+        with Session():
+            first = Member().get(id=1)
+            second = Member().get(id=1)
+            objs = list(Member().all())
+        self.assertIs(first, second)
+        self.assertIs(objs[0], first)
+        self.assertEqual(self.queries().count(
+            'SELECT id, name, age FROM member WHERE id=%s;'), 1)
+
+    def test_session_commit(self):
+        self.respond = lambda query, params: \
+            [(5,), (6,)] if query.startswith('INSERT') else \
+            [(1, 'Jesse', 25)]
+        with Session() as session:
+            person = Member().get(id=1)
+            person.age = 26
+            session.add(person)
+            session.add(Member(name='a'))
+            session.add(Member(name='b'))
+        self.assertEqual([query.split()[0] for query in self.queries()[3:]],
+                         ['BEGIN;', 'INSERT', 'UPDATE', 'COMMIT;'])
+        self.assertEqual(self.queries()[4],
+                         "INSERT INTO member (name, age) "
+                         "VALUES ('a',NULL),('b',NULL) RETURNING id;")
+        self.assertEqual(self.queries()[5],
+                         'UPDATE member SET age=26 WHERE id=1;')
+        self.assertEqual(person.changes(), [])
+
+
+class TestQuerySet(SyncTestCase):
+
+    rows = [(id, f'n{id}', age) for id, age in
+            [(1, 30), (2, 20), (3, 30), (4, 10), (5, 20), (6, 40), (7, 30)]]
+
+    def setUp(self):
+        super().setUp()
+        MetaORM._schema['member'] = True
+        self.respond = self.select
+
+    def select(self, query, params):
+        '''Rows ordered by (age, id), after (age, id) if given.'''
+        rows = sorted(self.rows, key=lambda row: (row[2], row[0]))
+        if 'WHERE' in query:
+            rows = [row for row in rows
+                    if (row[2], row[0]) > tuple(params[:2])]
+        if query.startswith('SELECT id, name FROM'):
+            rows = [row[:2] for row in rows]
+        return rows[:params[-1]]
+
+    def test_sql(self):
+        query = Member().filter(age__gte=18, name__in=['a', 'b']) \
+            .order_by('-age').limit(10).offset(20)
+        self.assertEqual(query.sql(), (
+            'SELECT id, name, age FROM member WHERE age >= %s AND name IN %s '
+            'ORDER BY age DESC LIMIT %s OFFSET %s',
+            [18, ('a', 'b'), 10, 20]))
+        self.assertEqual(Member().filter(name=None, age__in=[]).sql()[0],
+                         'SELECT id, name, age FROM member '
+                         'WHERE name IS NULL AND FALSE')
+        self.assertEqual(self.queries(), [])
+
+    def test_pages_with_only(self):
+        query = Member().query().only('name').order_by('age')
+        pages = list(query.pages(3))
+        self.assertEqual([[obj.id for obj in page] for page in pages],
+                         [[4, 2, 5], [1, 3, 7], [6]])
+        self.assertEqual(self.params()[-2], [30, 7, 3])
+
+    def test_only_not_in_identity_map(self):
+        self.respond = lambda query, params: \
+            [(1, 'n1')] if 'name FROM' in query else [(1, 'n1', 30)]
+        with Session() as session:
+            partial = Member().query().only('name').first()
+            self.assertIsNone(partial.age)
+            self.assertEqual(Member().get(id=1).age, 30)
+            self.assertIs(Member().get(id=1), session.identity[('member', 1)])
+
+
+class TestIndexes(unittest.TestCase):
+
+    def test_partial_indexes(self):
+        class Account(DatabaseORM):
+            age = Integer(index=True)
+            _indexes = [Index('age', where='age > 18'),
+                        Index('age', where='age < 18', unique=True)]
+
+        names = [index.name for index in Account._indexes]
+        self.assertEqual(names[0], 'account_age_idx')
+        self.assertRegex(names[1], r'^account_age_[0-9a-f]{8}_idx$')
+        self.assertRegex(names[2], r'^account_age_[0-9a-f]{8}_key$')
+        self.assertEqual(len(set(names)), 3)
+        self.assertEqual(
+            ' '.join(Account._indexes[1].sql('account', True).split()),
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {names[1]} '
+            'ON account (age) WHERE age > 18;')
+
+    def test_duplicate_names(self):
+        with self.assertRaises(ValueError):
+            class Account(DatabaseORM):
+                age = Integer(index=True)
+                _indexes = [Index('age')]
+
+    def test_long_names(self):
+        fields = {f'field_{i}_with_a_long_name': Integer()
+                  for i in range(4)}
+        fields['_indexes'] = [Index(*list(fields)[:4]),
+                              Index(*list(fields)[:3])]
+        Account = MetaORM('Account', (DatabaseORM,), fields)
+        names = [index.name for index in Account._indexes]
+        self.assertTrue(all(len(name) == 63 for name in names))
+        self.assertNotEqual(names[0], names[1])
+
+
+class CachedPerson(DatabaseORM):
+    _cache = True
+    name = String(20, not_null=True)
+    age = Integer()
+
+
+class TestRowCache(SyncTestCase):
+
+    key = ('cached_person', 1)
+
+    def setUp(self):
+        super().setUp()
+        MetaORM._schema['cached_person'] = True
+        self.respond = lambda query, params: \
+            [(1, 'Jesse', 25)] if query.startswith('SELECT') else []
+
+    def test_get_cached_after_commit(self):
+        with connection.transaction():
+            CachedPerson().get(id=1)
+            self.assertEqual(len(row_cache), 0)
+        self.assertEqual(row_cache.get(self.key), (1, 'Jesse', 25))
+        person = CachedPerson().get(id=1)
+        self.assertEqual(person.age, 25)
+        self.assertEqual(self.queries().count('BEGIN;'), 1)
+
+    def test_update_invalidates_after_commit(self):
+        person = CachedPerson().get(id=1)
+        person.age = 26
+        with connection.transaction():
+            person.save()
+            self.assertIsNotNone(row_cache.get(self.key))
+        self.assertIsNone(row_cache.get(self.key))
+
+    def test_stale_row_not_cached(self):
+        with connection.transaction():
+            CachedPerson().get(id=1)
+            # another thread commits an update to the row meanwhile
+            row_cache.invalidate(self.key)
+        self.assertIsNone(row_cache.get(self.key))
+        CachedPerson().get(id=1)
+        self.assertIsNotNone(row_cache.get(self.key))
+
+    def test_generations_bounded(self):
+        cache = RowCache(max_size=2)
+        generation = cache.generation()
+        for id in range(2, 5):
+            cache.invalidate(('cached_person', id))
+        cache.set(self.key, (1, 'Jesse', 25), generation)
+        self.assertIsNone(cache.get(self.key))
+        cache.set(self.key, (1, 'Jesse', 25), cache.generation())
+        self.assertIsNotNone(cache.get(self.key))
+        self.assertEqual(len(cache._invalidated), 2)
+
+    def test_rollback_drops_callbacks(self):
+        row_cache.set(self.key, (1, 'Jesse', 25))
+        person = CachedPerson().get(id=1)
+        person.age = 26
+        with self.assertRaises(KeyError):
+            with connection.transaction():
+                person.save()
+                raise KeyError
+        self.assertIsNotNone(row_cache.get(self.key))
+
+
+class Person(AsyncDatabaseORM):
+    name = String(20, not_null=True)
+    age = Integer()
+
+
+class Indexed(AsyncDatabaseORM):
+    name = String(20, unique=True, index=True)
+
+
+class TestAsyncORM(unittest.TestCase):
+
+    def setUp(self):
+        MetaORM._schema['person'] = True
+        self.drivers = []
+
+    def run_with_pool(self, coro_func, respond=lambda query, params: [],
+                      **pool_data):
+        async def connect(**db_data):
+            driver = FakeDriver(respond)
+            self.drivers.append(driver)
+            return driver
+
+        async def main():
+            pool = AsyncConnectionPool(connect=connect, **pool_data)
+            async_orm._pools[asyncio.get_running_loop()] = pool
+            return await coro_func()
+
+        return asyncio.run(main())
+
+    def queries(self):
+        return [query for driver in self.drivers
+                for query, _ in driver.queries]
+
+    def commands(self):
+        return [query.split()[0].rstrip(';') for query in self.queries()]
+
+    def test_get(self):
+        def respond(query, params):
+            if query.startswith('SELECT'):
+                yield (7, 'Jesse', 25)
+
+        person = self.run_with_pool(lambda: Person().get(id=7), respond)
+        self.assertEqual((person.id, person.name, person.age),
+                         (7, 'Jesse', 25))
+        self.assertEqual(self.queries(), [
+            'BEGIN;',
+            'SELECT id, name, age FROM person WHERE id=%s;',
+            'COMMIT;',
+        ])
+        self.assertEqual(self.drivers[0].queries[1][1], [7])
+
+    def test_autocommit_skips_transaction(self):
+        async def get():
+            await Person().get(id=7)
+            async with async_orm.async_transaction():
+                await Person().get(id=8)
+
+        self.run_with_pool(get, autocommit=True)
+        self.assertEqual(self.commands(),
+                         ['SELECT', 'BEGIN', 'SELECT', 'COMMIT'])
+
+    def test_insert_many(self):
+        def respond(query, params):
+            if query.startswith('INSERT'):
+                yield from ((i,) for i in range(len(params) // 2))
+
+        rows = [{'name': f'n{i}', 'age': i} for i in range(5)]
+        ids = self.run_with_pool(
+            lambda: Person().insert_many(rows, batch_size=2), respond)
+        self.assertEqual(ids, [0, 1, 0, 1, 0])
+        self.assertEqual(self.commands(),
+                         ['BEGIN', 'INSERT', 'COMMIT'] * 3)
+
+    def test_insert_many_validation(self):
+        with self.assertRaises(ValueError):
+            self.run_with_pool(
+                lambda: Person().insert_many([{'name': 'n', 'age': 'a'}]))
+
+    def test_transaction_rollback(self):
+        async def fail():
+            async with async_orm.async_transaction():
+                await Person().insert(name='Walter')
+                raise KeyError
+
+        with self.assertRaises(KeyError):
+            self.run_with_pool(fail, lambda query, params: [(1,)])
+        self.assertEqual(self.commands(),
+                         ['BEGIN', 'INSERT', 'ROLLBACK'])
+
+    def test_stream(self):
+        fetched = []
+
+        def respond(query, params):
+            if query.startswith('FETCH') and len(fetched) < 2:
+                fetched.append(query)
+                yield (len(fetched), 'Jesse', None)
+
+        async def stream():
+            return [person.id async for person in
+                    Person().all(stream=True, itersize=1)]
+
+        self.assertEqual(self.run_with_pool(stream, respond), [1, 2])
+        self.assertEqual(self.commands(),
+                         ['BEGIN', 'DECLARE', 'FETCH', 'FETCH', 'FETCH',
+                          'CLOSE', 'COMMIT'])
+
+    def test_stream_closed_after_save(self):
+        async def save_first():
+            people = Person().all(stream=True)
+            async for person in people:
+                person.name = 'Walter'
+                await person.save()
+                break
+            await people.aclose()
+
+        self.run_with_pool(save_first, lambda query, params:
+                           [(1, 'Jesse', 25)] if 'FETCH' in query else [])
+        stream, save = ([query.split()[0].rstrip(';')
+                         for query, _ in driver.queries]
+                        for driver in self.drivers)
+        self.assertEqual(stream, ['BEGIN', 'DECLARE', 'FETCH', 'CLOSE',
+                                  'ROLLBACK'])
+        self.assertEqual(save, ['BEGIN', 'UPDATE', 'COMMIT'])
+
+    def test_create_missing_indexes(self):
+        def respond(query, params):
+            if 'pg_indexes' in query:
+                yield ('person_age_idx',)
+
+        created = self.run_with_pool(
+            lambda: Indexed.create_missing_indexes(), respond)
+        self.assertEqual([index.name for index in created],
+                         ['indexed_name_key'])
+        self.assertEqual(self.commands(), ['SELECT', 'CREATE'])
+        self.assertIn('CONCURRENTLY', self.queries()[1])
+
+    def test_refresh_schema(self):
+        MetaORM._schema.pop('person')
+        exists = self.run_with_pool(lambda: Person.refresh_schema(),
+                                    lambda query, params: [(1,)])
+        self.assertIs(exists, True)
+        self.assertIs(MetaORM._schema['person'], True)
+
+    def test_query_blocked(self):
+        with self.assertRaises(MethodUsageError):
+            Person().filter(age=1)
+
+    def test_pool_bounded(self):
+        async def gather():
+            return await asyncio.gather(*(Person().get(id=i)
+                                          for i in range(10)))
+
+        self.run_with_pool(gather, max_size=2)
+        self.assertEqual(len(self.drivers), 2)
+
+    def test_pool_timeout(self):
+        async def hold():
+            pool = async_orm.get_async_pool()
+            async with pool.connection():
+                async with asyncio.timeout(1):
+                    await asyncio.create_task(Person().get(id=1))
+
+        with self.assertRaises(PoolTimeout):
+            self.run_with_pool(hold, max_size=1, timeout=0.01)
+
+
+class TestQueryStats(unittest.TestCase):
+
+    def test_record(self):
+        stats = QueryStats(sample_rate=0, slow_threshold=0.5)
+        for elapsed in (0.0001, 0.002, 0.002, 0.7):
+            stats.record('SELECT  *\n FROM person WHERE id=%s;', [1],
+                         elapsed)
+        snapshot = stats.snapshot()['SELECT * FROM person WHERE id=%s;']
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['max'], 0.7)
+        self.assertEqual(snapshot['p50'], 0.0025)
+        self.assertEqual(snapshot['p99'], 0.7)
+        self.assertEqual([slow['params'] for slow in stats.slow_queries],
+                         [[1]])
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+
+class TestLogger(unittest.TestCase):
+
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = temp.name
+
+    def test_get_logger_idempotent(self):
+        first = logger.get_logger('tests')
+        second = logger.get_logger('tests')
+        self.assertIs(first, second)
+        self.assertEqual(len(second.handlers), 1)
+
+    def test_drop_policy(self):
+        handler = logger.BoundedQueueHandler(queue.Queue(1), 'drop')
+        log = logging.getLogger('tests.drop')
+        log.setLevel(logging.INFO)
+        log.propagate = False
+        log.addHandler(handler)
+        log.info('kept')
+        log.info('dropped')
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), 'kept')
+
+    def test_stream_handler_follows_stderr(self):
+        handler = logger.get_stream_handler()
+        record = logging.makeLogRecord({'levelno': logging.INFO,
+                                        'msg': 'written'})
+        for _ in range(2):
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                handler.handle(record)
+            self.assertIn('written', stderr.getvalue())
+            stderr.close()
+
+    def test_listener_survives_handler_errors(self):
+        class Broken(logger.StreamHandler):
+            def flush(self):
+                raise ValueError('I/O operation on closed file.')
+
+            def handleError(self, record):
+                self.errors += 1
+
+        class Kept(logging.Handler):
+            def emit(self, record):
+                self.records.append(record.msg)
+
+        broken = Broken()
+        broken.errors = 0
+        kept = Kept()
+        kept.records = []
+        listener = logger.BatchQueueListener(queue.Queue(1), broken, kept,
+                                             directory=self.directory)
+        listener.start()
+        for i in range(3):
+            listener.queue.put(logging.makeLogRecord(
+                {'name': 'tests', 'levelno': logging.INFO, 'msg': i}))
+        listener.stop()
+        self.assertEqual(kept.records, [0, 1, 2])
+        self.assertGreater(broken.errors, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Load generator for the search service.
+
+Runs --clients concurrent clients sending a weighted mix of queries at a
+total target --rate (requests per second, 0 for as fast as possible) for
+--duration seconds and reports the throughput and latency percentiles.
+Latencies are measured from the time a request was scheduled, so a
+server that falls behind the target rate is not flattered by the
+clients waiting for it.
+
+With --spawn CONFIG the server is started in a subprocess with a stub
+search backend that sleeps --stub-delay seconds instead of calling
+Wikipedia, so runs are repeatable and need no network. Its search cache
+is off unless --cache is given, so every request reaches the backend:
+
+    ./benchmark.py --spawn config --clients 50 --rate 500 --output a.json
+"""
+from time import perf_counter, sleep, time
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+from cache import SearchCache
+import client
+import server
+
+
+QUERIES = ['Moscow', 'Python', 'Linux', 'Saint Petersburg', 'TCP',
+           'Wikipedia', 'Asyncio', 'PostgreSQL', 'Volga', 'Lomonosov']
+
+
+def stub_search(query, delay=0.0):
+    sleep(delay)
+    return [query, f'{query} (disambiguation)']
+
+
+def parse_mix(queries):
+    """Turn ['a:3', 'b'] into (['a', 'b'], [3.0, 1.0])."""
+    names, weights = [], []
+    for query in queries:
+        name, _, weight = query.rpartition(':')
+        if not name or not weight.replace('.', '', 1).isdigit():
+            name, weight = query, 1
+        names.append(name)
+        weights.append(float(weight))
+    return names, weights
+
+
+def percentile(latencies, q):
+    """Nearest-rank percentile of sorted latencies."""
+    if not latencies:
+        return None
+    rank = max(int(round(q * len(latencies) + 0.5)) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+class Worker(threading.Thread):
+    """One client sending requests on its own schedule."""
+
+    def __init__(self, send, requests, interval, start, stop, seed):
+        super().__init__(daemon=True)
+        self.send = send
+        self.requests = requests
+        self.interval = interval
+        self.start_time = start
+        self.stop_time = stop
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.errors = dict()
+
+    def run(self):
+        names, weights = self.requests
+        scheduled = self.start_time
+        while scheduled < self.stop_time:
+            if self.interval:
+                delay = scheduled - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            else:
+                scheduled = perf_counter()
+            query = self.random.choices(names, weights)[0]
+            try:
+                response = self.send(f'q={query}&format=json')
+                if response.startswith('Bab request'):
+                    raise RuntimeError(response)
+            except Exception as error:
+                name = type(error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+            else:
+                self.latencies.append(perf_counter() - scheduled)
+            scheduled += self.interval
+
+
+def run(args):
+    address = (args.host, args.port)
+    pool = client.ConnectionPool(address, args.clients, args.timeout)
+    if args.keep_alive:
+        send = pool.request
+    else:
+        send = lambda request: client.request_once(request, address,
+                                                   args.timeout)
+
+    interval = args.clients / args.rate if args.rate else 0
+    start = perf_counter() + 0.1
+    stop = start + args.duration
+    mix = parse_mix(args.query or QUERIES)
+    workers = [Worker(send, mix, interval,
+                      start + interval * i / args.clients, stop,
+                      args.seed + i)
+               for i in range(args.clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = max(perf_counter(), stop) - start
+    pool.close()
+
+    latencies = sorted(latency for worker in workers
+                       for latency in worker.latencies)
+    errors = dict()
+    for worker in workers:
+        for name, count in worker.errors.items():
+            errors[name] = errors.get(name, 0) + count
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'timestamp': time(),
+        'settings': {
+            'address': f'{args.host}:{args.port}',
+            'mode': args.mode,
+            'cache': args.cache if args.mode else None,
+            'stub_delay': args.stub_delay if args.mode else None,
+            'clients': args.clients,
+            'rate': args.rate,
+            'duration': args.duration,
+            'keep_alive': args.keep_alive,
+            'queries': mix[0],
+            'weights': mix[1],
+        },
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 2),
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies) if latencies
+                       else None),
+            'p50': ms(percentile(latencies, 0.5)),
+            'p95': ms(percentile(latencies, 0.95)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def wait_for_port(address, timeout=10):
+    deadline = perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection(address, 1).close()
+            return
+        except OSError:
+            if perf_counter() > deadline:
+                raise
+            sleep(0.05)
+
+
+def spawn_server(config_file, stub_delay, use_cache=False):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--stub-server', config_file,
+                             '--stub-delay', str(stub_delay)] +
+                            ['--cache'] * use_cache)
+
+
+def serve_stub(config_file, stub_delay, use_cache=False):
+    server.search = lambda query: stub_search(query, stub_delay)
+    if not use_cache:
+        # an entry is dropped as soon as it is stored; concurrent misses
+        # of a query still share one backend call
+        server.SearchCache = lambda search, *args: SearchCache(search, 0)
+    server.main([config_file])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', default=client.ADDRESS[0])
+    parser.add_argument('--port', type=int, default=client.ADDRESS[1])
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='total requests per second, 0 for no limit')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--query', action='append',
+                        help='query of the mix, optionally weighted as '
+                             'QUERY:WEIGHT; may be repeated')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use pooled framed connections')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--spawn', metavar='CONFIG',
+                        help='start a stub-backed server with this config')
+    parser.add_argument('--stub-delay', type=float, default=0.01,
+                        help='seconds the stub search backend sleeps')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the search cache of the spawned server')
+    parser.add_argument('--stub-server', metavar='CONFIG',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stub_server:
+        serve_stub(args.stub_server, args.stub_delay, args.cache)
+        sys.exit()
+
+    process = None
+    args.mode = None
+    if args.spawn:
+        config = server.Config(args.spawn)
+        args.port, args.mode = config.port, config.mode
+        process = spawn_server(args.spawn, args.stub_delay, args.cache)
+    try:
+        if process:
+            wait_for_port((args.host, args.port))
+        results = run(args)
+    finally:
+        if process:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    report = json.dumps(results, indent=4, ensure_ascii=False)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(report + '\n')
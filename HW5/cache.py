@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import json
+import os
+import threading
+import time
+
+
+class SearchCache():
+    """
+    TTL + LRU cache of search results keyed on the normalized query.
+
+    Concurrent misses of the same query are collapsed into one call of
+    the search backend (single flight): the other callers wait for its
+    result. With a path the entries survive restarts: load() reads them
+    back, save() writes them out.
+    """
+
+    def __init__(self, search, max_size=1024, ttl=300, path=None,
+                 clock=time.time):
+        self.search = search
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def normalize(query):
+        return ' '.join(query.split()).casefold()
+
+    def get(self, query):
+        key = self.normalize(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            future = self._pending.get(key)
+            leader = future is None
+            if leader:
+                future = self._pending[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = tuple(self.search(query))
+        except BaseException as error:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(error)
+            raise
+        with self._lock:
+            self._store(key, self.clock() + self.ttl, result)
+            del self._pending[key]
+        future.set_result(result)
+        return result
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hit_ratio(),
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return
+        now = self.clock()
+        with self._lock:
+            for key, expires, result in entries:
+                if expires > now:
+                    self._store(key, expires, tuple(result))
+
+    def save(self):
+        with self._lock:
+            entries = [[key, expires, result] for key, (expires, result)
+                       in self._entries.items()]
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(entries, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def _store(self, key, expires, result):
+        self._entries[key] = (expires, result)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
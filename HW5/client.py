@@ -1,18 +1,106 @@
 #!/usr/bin/env python
-import socket
+from contextlib import contextmanager
 import argparse
+import queue
+import socket
+
+import protocol
+
+
+ADDRESS = ('127.0.0.1', 9111)
+
+
+def request_once(request, address=ADDRESS, timeout=None):
+    """Send a request in the one-shot mode: one connection per request."""
+    with socket.create_connection(address, timeout) as sock:
+        sock.sendall(request.encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        return protocol.receive_all(sock)
+
+
+class Connection():
+    """Keep-alive connection speaking the framed protocol."""
+
+    def __init__(self, address=ADDRESS, timeout=None):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, request):
+        self.sock.sendall(protocol.encode(request))
+        return protocol.receive_message(self.sock)
+
+    def pipeline(self, requests):
+        """Send all the requests at once, then read their responses."""
+        self.sock.sendall(b''.join(map(protocol.encode, requests)))
+        return [protocol.receive_message(self.sock) for _ in requests]
+
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionPool():
+    """
+    Thread-safe pool of up to size keep-alive connections, opened on
+    demand. A connection that failed is closed instead of being reused.
+    """
+
+    def __init__(self, address=ADDRESS, size=4, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self.slots = queue.LifoQueue(size)
+        for _ in range(size):
+            self.slots.put(None)
+
+    @contextmanager
+    def connection(self):
+        conn = self.slots.get()
+        try:
+            if conn is None:
+                conn = Connection(self.address, self.timeout)
+            yield conn
+        except BaseException:
+            if conn is not None:
+                conn.close()
+            conn = None
+            raise
+        finally:
+            self.slots.put(conn)
+
+    def request(self, request):
+        with self.connection() as conn:
+            return conn.request(request)
 
+    def pipeline(self, requests):
+        with self.connection() as conn:
+            return conn.pipeline(requests)
 
-sock = socket.socket()
-sock.connect(('127.0.0.1', 9111))
+    def close(self):
+        while True:
+            try:
+                conn = self.slots.get_nowait()
+            except queue.Empty:
+                return
+            if conn is not None:
+                conn.close()
 
-parser = argparse.ArgumentParser()
-parser.add_argument('request', help='arguments for request')
-args = parser.parse_args()
-request = args.request
 
-sock.sendall(request.encode('utf-8'))
-data = sock.recv(1024)
-sock.close()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('request', nargs='+', help='arguments for request')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='send the requests over one framed connection')
+    parser.add_argument('--port', type=int, default=ADDRESS[1])
+    args = parser.parse_args()
+    address = (ADDRESS[0], args.port)
 
-print(data.decode('utf-8'))
+    if args.keep_alive:
+        conn = Connection(address)
+        try:
+            responses = conn.pipeline(args.request)
+        finally:
+            conn.close()
+    else:
+        responses = [request_once(request, address)
+                     for request in args.request]
+    for response in responses:
+        print(response)
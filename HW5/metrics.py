@@ -0,0 +1,146 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+import threading
+
+
+def _format(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Metrics():
+    """
+    Request metrics of one server process, kept in a flat array of
+    doubles: request counters, error counters by type and a latency
+    histogram per phase of request handling. In the prefork mode the
+    arrays of all worker slots live in shared memory, so the supervisor
+    can combine them and a restarted worker keeps counting where its
+    predecessor stopped.
+    """
+
+    FIELDS = ('requests', 'time', 'max_time')
+    ERRORS = ('wrong_format', 'missing_args', 'timeout', 'protocol',
+              'connection_lost')
+    PHASES = ('accept_wait', 'recv', 'parse', 'search', 'serialize',
+              'send')
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    # each phase: one count per bucket followed by the sum of the values
+    SIZE = len(FIELDS) + len(ERRORS) + len(PHASES) * (len(BOUNDS) + 1)
+    INDEX = dict(zip(FIELDS, range(len(FIELDS))))
+    ERROR_INDEX = dict(zip(ERRORS, range(len(FIELDS), SIZE)))
+    PHASE_INDEX = dict(zip(PHASES, range(len(FIELDS) + len(ERRORS), SIZE,
+                                         len(BOUNDS) + 1)))
+
+    def __init__(self, values=None):
+        if values is None:
+            values = [0.0] * self.SIZE
+        self.values = values
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, count):
+        """Return metrics for count processes backed by shared memory."""
+        return [cls(multiprocessing.RawArray('d', cls.SIZE))
+                for _ in range(count)]
+
+    def add(self, field, amount=1):
+        with self._lock:
+            self.values[self.INDEX[field]] += amount
+
+    def error(self, kind):
+        with self._lock:
+            self.values[self.ERROR_INDEX[kind]] += 1
+
+    def observe(self, phase, elapsed):
+        start = self.PHASE_INDEX[phase]
+        with self._lock:
+            self.values[start + bisect_left(self.BOUNDS, elapsed)] += 1
+            self.values[start + len(self.BOUNDS)] += elapsed
+
+    def request(self, elapsed):
+        with self._lock:
+            self.values[self.INDEX['requests']] += 1
+            self.values[self.INDEX['time']] += elapsed
+            i = self.INDEX['max_time']
+            if elapsed > self.values[i]:
+                self.values[i] = elapsed
+
+    def snapshot(self):
+        values = self.values[:]
+        snapshot = dict(zip(self.FIELDS, values))
+        snapshot['errors'] = {kind: values[i]
+                              for kind, i in self.ERROR_INDEX.items()}
+        return snapshot
+
+    @classmethod
+    def combine(cls, metrics):
+        total = cls()
+        max_time = cls.INDEX['max_time']
+        for item in metrics:
+            for i, value in enumerate(item.values[:]):
+                if i == max_time:
+                    total.values[i] = max(total.values[i], value)
+                else:
+                    total.values[i] += value
+        return total
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        values = self.values[:]
+        lines = [
+            '# HELP search_requests_total Requests handled.',
+            '# TYPE search_requests_total counter',
+            'search_requests_total '
+            f'{_format(values[self.INDEX["requests"]])}',
+            '# HELP search_request_seconds_max Longest request.',
+            '# TYPE search_request_seconds_max gauge',
+            'search_request_seconds_max '
+            f'{_format(values[self.INDEX["max_time"]])}',
+            '# HELP search_errors_total Failed requests by error type.',
+            '# TYPE search_errors_total counter',
+        ]
+        for kind, i in self.ERROR_INDEX.items():
+            lines.append(f'search_errors_total{{type="{kind}"}} '
+                         f'{_format(values[i])}')
+        lines.append('# HELP search_phase_seconds Time spent in each phase '
+                     'of request handling.')
+        lines.append('# TYPE search_phase_seconds histogram')
+        for phase, start in self.PHASE_INDEX.items():
+            count = 0.0
+            buckets = values[start:start + len(self.BOUNDS)]
+            for bound, bucket in zip(self.BOUNDS, buckets):
+                count += bucket
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'search_phase_seconds_bucket{{phase="{phase}",'
+                             f'le="{le}"}} {_format(count)}')
+            lines.append(f'search_phase_seconds_sum{{phase="{phase}"}} '
+                         f'{_format(values[start + len(self.BOUNDS)])}')
+            lines.append(f'search_phase_seconds_count{{phase="{phase}"}} '
+                         f'{_format(count)}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, collect):
+    """
+    Serve the text returned by collect() to any GET request on the local
+    port from a daemon thread; return the HTTP server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = collect().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
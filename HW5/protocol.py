@@ -0,0 +1,89 @@
+"""
+Framed protocol of the search service.
+
+Every message is a version byte, the payload length as a 4-byte big
+endian integer and the UTF-8 payload. A client opening a connection with
+a framed message may keep it open and send further requests before the
+previous responses arrive (pipelining); the responses come back in the
+order of the requests. A connection starting with anything else is
+served in the old one-shot mode: one raw request, one raw response.
+"""
+import asyncio
+import struct
+
+
+VERSION = 1
+MAX_SIZE = 1024 * 1024
+
+HEADER = struct.Struct('!BI')
+LENGTH = struct.Struct('!I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(message):
+    payload = message.encode('utf-8')
+    if len(payload) > MAX_SIZE:
+        raise ProtocolError(f'message of {len(payload)} bytes is too long')
+    return HEADER.pack(VERSION, len(payload)) + payload
+
+
+def check_version(version):
+    if version != VERSION:
+        raise ProtocolError(f'unsupported protocol version {version}')
+
+
+def check_length(length):
+    if length > MAX_SIZE:
+        raise ProtocolError(f'message of {length} bytes is too long')
+
+
+async def read_message(reader, version=None):
+    """
+    Read one message from an asyncio stream; version is the version byte
+    when the caller has already read it. Return None at the end of the
+    stream.
+    """
+    if version is None:
+        version = await reader.read(1)
+        if not version:
+            return None
+        version = version[0]
+    check_version(version)
+    try:
+        length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+        check_length(length)
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('connection closed inside a message')
+    return payload.decode('utf-8')
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProtocolError('connection closed inside a message')
+        data += chunk
+    return bytes(data)
+
+
+def receive_message(sock):
+    """Read one message from a blocking socket."""
+    version, length = HEADER.unpack(receive_exactly(sock, HEADER.size))
+    check_version(version)
+    check_length(length)
+    return receive_exactly(sock, length).decode('utf-8')
+
+
+def receive_all(sock):
+    """Read a raw one-shot response, which ends when the server closes."""
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks).decode('utf-8')
+        chunks.append(chunk)
@@ -1,11 +1,25 @@
 #!/usr/bin/env python
-from time import time
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep, time
 import configparser
 import argparse
+import asyncio
+import os
+import signal
 import socket
 import logging
+import traceback
 import wikipedia
 
+from cache import SearchCache
+from metrics import Metrics, serve_metrics
+import protocol
+
+
+PIPELINE_DEPTH = 32
+# mode names of older config files
+MODE_ALIASES = {'demon': 'serial'}
+
 
 class Config():
     def __init__(self, config_path):
@@ -15,8 +29,22 @@ class Config():
         self.port = int(config['DEFAULT']['port'])
         self.log_file = config['DEFAULT']['log_file']
         self.mode = config['DEFAULT']['mode']
+        self.mode = MODE_ALIASES.get(self.mode, self.mode)
         self.timeout = int(config['DEFAULT']['timeout'])
         self.max_connections = int(config['DEFAULT']['max_connections'])
+        self.workers = config['DEFAULT'].getint('workers', 16)
+        self.request_timeout = config['DEFAULT'].getfloat('request_timeout',
+                                                          10)
+        self.cache_size = config['DEFAULT'].getint('cache_size', 1024)
+        self.cache_ttl = config['DEFAULT'].getfloat('cache_ttl', 300)
+        self.cache_file = config['DEFAULT'].get('cache_file', '')
+        self.processes = config['DEFAULT'].getint('processes',
+                                                  os.cpu_count() or 1)
+        self.reuse_port = config['DEFAULT'].getboolean('reuse_port', False)
+        self.drain_timeout = config['DEFAULT'].getfloat('drain_timeout', 10)
+        self.report_interval = config['DEFAULT'].getfloat('report_interval',
+                                                          60)
+        self.metrics_port = config['DEFAULT'].getint('metrics_port', 0)
 import argparse
 
 
@@ -32,29 +60,211 @@ def get_logger(log_file):
     return logger
 
 
+def search(query):
+    return wikipedia.search(query)
+
+
+cache = SearchCache(search)
+metrics = Metrics()
+
+
 def make_response(data):
+    start = perf_counter()
     try:
         data = data.split('&')
         data = dict(map(lambda x: x.split('='), data))
     except ValueError:
         logger.error('Bab request: wrong format')
+        metrics.error('wrong_format')
         return 'Bab request: wrong format'
     if 'format' in data and 'q' in data:
-        return str({i:entity for i, entity in
-                    enumerate(wikipedia.search(data['q']))})
+        parsed = perf_counter()
+        metrics.observe('parse', parsed - start)
+        results = cache.get(data['q'])
+        found = perf_counter()
+        metrics.observe('search', found - parsed)
+        response = str({i:entity for i, entity in enumerate(results)})
+        metrics.observe('serialize', perf_counter() - found)
+        return response
     else:
         logger.error('Bab request: no "format" or "q" arguments')
+        metrics.error('missing_args')
         return 'Bab request: no "format" or "q" arguments'
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('config_file', help='configuration file')
+class WorkerPool():
+    """
+    Thread pool for the blocking search calls with at most size calls in
+    flight; a call abandoned by a timed out request keeps its slot until
+    it really finishes, so slow upstream calls cannot pile up.
+    """
 
-    args = parser.parse_args()
-    config = Config(args.config_file)
-    logger = get_logger(config.log_file)
+    def __init__(self, size):
+        self.executor = ThreadPoolExecutor(size)
+        self.slots = asyncio.Semaphore(size)
+
+    async def run(self, func, *args):
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def respond(request, pool, timeout, start_time):
+    try:
+        async with asyncio.timeout(timeout):
+            response = await pool.run(make_response, request)
+    except TimeoutError:
+        logger.error('Bab request: timeout')
+        response = 'Bab request: timeout'
+        metrics.error('timeout')
+
+    all_time = time() - start_time
+    metrics.request(all_time)
+    logger.info(f'time: {all_time}, size: {len(request)}, '
+                f'cache hit ratio: {cache.hit_ratio():.3f}')
+    return response
+
+
+async def handle_client(reader, writer, pool, config):
+    start_time = time()
+    try:
+        async with asyncio.timeout(config.request_timeout):
+            data = await reader.read(1)
+            received = perf_counter()
+            if data and data[0] != protocol.VERSION:
+                data += await reader.read(1023)
+                metrics.observe('recv', perf_counter() - received)
+        if data and data[0] == protocol.VERSION:
+            await serve_framed(data[0], reader, writer, pool, config)
+        elif data:
+            response = await respond(data.decode('utf-8'), pool,
+                                     config.request_timeout, start_time)
+            sending = perf_counter()
+            writer.write(response.encode('utf-8'))
+            await writer.drain()
+            metrics.observe('send', perf_counter() - sending)
+    except TimeoutError:
+        logger.error('Bab request: timeout')
+        metrics.error('timeout')
+    except protocol.ProtocolError as error:
+        logger.error(f'Bab request: {error}')
+        metrics.error('protocol')
+    except ConnectionError:
+        logger.error('Connection lost')
+        metrics.error('connection_lost')
+    finally:
+        writer.close()
+
+
+async def serve_framed(version, reader, writer, pool, config):
+    """
+    Serve a keep-alive connection: read the framed requests as they come,
+    handle up to PIPELINE_DEPTH of them concurrently and write the
+    responses back in the order of the requests.
+    """
+    responses = asyncio.Queue(PIPELINE_DEPTH)
+
+    async def write_responses():
+        while (response := await responses.get()) is not None:
+            response = protocol.encode(await response)
+            sending = perf_counter()
+            writer.write(response)
+            await writer.drain()
+            metrics.observe('send', perf_counter() - sending)
+
+    async def enqueue(response):
+        # the writer may die (e.g. on a reset) while the queue is full
+        put = asyncio.ensure_future(responses.put(response))
+        await asyncio.wait((put, writing),
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            response.cancel()
+
+    writing = asyncio.create_task(write_responses())
+    try:
+        while not writing.done():
+            if version is None:
+                try:
+                    async with asyncio.timeout(config.timeout):
+                        version = await reader.read(1)
+                except TimeoutError:
+                    break
+                if not version:
+                    break
+                version = version[0]
+            received = perf_counter()
+            async with asyncio.timeout(config.request_timeout):
+                request = await protocol.read_message(reader, version)
+            metrics.observe('recv', perf_counter() - received)
+            version = None
+            await enqueue(asyncio.create_task(respond(
+                request, pool, config.request_timeout, time())))
+    finally:
+        if writing.done():
+            while not responses.empty():
+                responses.get_nowait().cancel()
+            writing.result()
+        await responses.put(None)
+        await writing
+
+
+async def serve_async(config, sock=None):
+    """
+    Serve clients concurrently until SIGINT or SIGTERM, then stop
+    accepting and give the open connections drain_timeout seconds to
+    finish. Listen on sock if given, on config.port otherwise.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    pool = WorkerPool(config.workers)
+    connections = set()
 
+    async def serve_connection(reader, writer, accepted):
+        metrics.observe('accept_wait', perf_counter() - accepted)
+        await handle_client(reader, writer, pool, config)
+
+    def client_connected(reader, writer):
+        # called as soon as the connection is accepted; the time until its
+        # task starts is the wait for the event loop
+        task = loop.create_task(
+            serve_connection(reader, writer, perf_counter()))
+        connections.add(task)
+        task.add_done_callback(connections.discard)
+
+    if sock is None:
+        server = await asyncio.start_server(
+            client_connected, port=config.port, reuse_address=True,
+            reuse_port=config.reuse_port or None, backlog=socket.SOMAXCONN)
+    else:
+        server = await asyncio.start_server(client_connected, sock=sock,
+                                            backlog=socket.SOMAXCONN)
+    logger.info(f'serving on port {config.port}')
+    await stop.wait()
+
+    server.close()
+    if connections:
+        logger.info(f'draining {len(connections)} connections')
+        _, pending = await asyncio.wait(connections,
+                                        timeout=config.drain_timeout)
+        for task in pending:
+            task.cancel()
+    await server.wait_closed()
+    pool.shutdown()
+    if cache.path:
+        cache.save()
+    logger.info('server stopped')
+
+
+def serve_serial(config):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.bind(('', config.port))
     sock.settimeout(config.timeout)
@@ -77,6 +287,143 @@ if __name__ == '__main__':
         conn.send(response.encode('utf-8'))
 
         all_time = time() - start_time
-        logger.info(f'time: {all_time}, size: {len(request)}')
+        logger.info(f'time: {all_time}, size: {len(request)}, '
+                    f'cache hit ratio: {cache.hit_ratio():.3f}')
+
+        conn.close()
+
+    if cache.path:
+        cache.save()
+
+
+def run_worker(config, sock, worker_metrics):
+    """Body of a prefork worker process; never returns."""
+    global metrics
+    metrics = worker_metrics
+    status = 0
+    try:
+        asyncio.run(serve_async(config, sock))
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        logging.shutdown()
+        os._exit(status)
+
+
+def serve_prefork(config):
+    """
+    Supervise config.processes worker processes serving the same port,
+    either through one listening socket they inherit or, with
+    reuse_port, through sockets of their own bound with SO_REUSEPORT.
+    Crashed workers are restarted; SIGINT or SIGTERM is passed on to the
+    workers, which drain their connections and exit. The request metrics
+    of the workers live in shared memory and are logged combined every
+    report_interval seconds and at exit.
+    """
+    sock = None
+    if not config.reuse_port:
+        sock = socket.create_server(('', config.port),
+                                    backlog=socket.SOMAXCONN)
+    slots = Metrics.shared(config.processes)
+    workers = dict()
+    started = [0.0] * config.processes
+    stopping = False
+
+    def spawn(slot):
+        started[slot] = time()
+        # the child must not run the supervisor's handlers before it
+        # installs its own
+        signals = {signal.SIGINT, signal.SIGTERM}
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            run_worker(config, sock, slots[slot])
+        workers[pid] = slot
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            os.kill(pid, signal.SIGTERM)
 
-        conn.close()
\ No newline at end of file
+    def report():
+        total = Metrics.combine(slots).snapshot()
+        logger.info(f'workers: {len(workers)}, '
+                    f'requests: {total["requests"]:.0f}, '
+                    f'errors: {sum(total["errors"].values()):.0f}, '
+                    f'timeouts: {total["errors"]["timeout"]:.0f}, '
+                    f'mean time: {total["time"] / (total["requests"] or 1)}, '
+                    f'max time: {total["max_time"]}')
+
+    for slot in range(config.processes):
+        spawn(slot)
+    if config.metrics_port:
+        serve_metrics(config.metrics_port,
+                      lambda: Metrics.combine(slots).render())
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info(f'started {config.processes} workers on port {config.port}')
+
+    restarts = dict()
+    next_report = time() + config.report_interval
+    while workers or restarts:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            # every worker is waiting for its restart
+            pid = 0
+        if pid:
+            slot = workers.pop(pid)
+            if not stopping:
+                logger.error(f'worker {pid} exited with status '
+                             f'{os.waitstatus_to_exitcode(status)}, '
+                             'restarting')
+                # a worker crashing at start is restarted after a pause
+                restarts[slot] = max(time(), started[slot] + 1)
+            continue
+        for slot, restart_time in list(restarts.items()):
+            if stopping:
+                restarts.clear()
+            elif restart_time <= time():
+                del restarts[slot]
+                spawn(slot)
+        if time() >= next_report:
+            report()
+            next_report = time() + config.report_interval
+        sleep(0.1)
+    report()
+    if sock is not None:
+        sock.close()
+    logger.info('server stopped')
+
+
+def main(argv=None):
+    global logger, cache
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file')
+
+    args = parser.parse_args(argv)
+    config = Config(args.config_file)
+    logger = get_logger(config.log_file)
+    cache = SearchCache(search, config.cache_size, config.cache_ttl,
+                        config.cache_file or None)
+
+    if config.mode == 'async':
+        if config.metrics_port:
+            serve_metrics(config.metrics_port, lambda: metrics.render())
+        asyncio.run(serve_async(config))
+    elif config.mode == 'prefork':
+        serve_prefork(config)
+    elif config.mode == 'serial':
+        serve_serial(config)
+    else:
+        parser.error(f'unknown mode "{config.mode}" in the config file')
+
+
+if __name__ == '__main__':
+    main()
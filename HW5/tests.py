@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from cache import SearchCache
+from metrics import Metrics
+import client
+import protocol
+import server
+
+
+class StubSearch():
+    """Search backend answering from the query itself, counting calls."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, query):
+        self.calls.append(query)
+        time.sleep(self.delay)
+        return [query, f'{query} (disambiguation)']
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.search = StubSearch()
+
+    def make_cache(self, **kwargs):
+        return SearchCache(self.search, clock=lambda: self.now, **kwargs)
+
+    def test_hit(self):
+        cache = self.make_cache()
+        cache.get('Moscow')
+        self.assertEqual(cache.get('  moscow '),
+                         ('Moscow', 'Moscow (disambiguation)'))
+        self.assertEqual(self.search.calls, ['Moscow'])
+        self.assertEqual(cache.hit_ratio(), 0.5)
+
+    def test_ttl(self):
+        cache = self.make_cache(ttl=10)
+        cache.get('Moscow')
+        self.now = 11
+        cache.get('Moscow')
+        self.assertEqual(len(self.search.calls), 2)
+
+    def test_lru(self):
+        cache = self.make_cache(max_size=2)
+        for query in ('a', 'b', 'a', 'c', 'a', 'b'):
+            cache.get(query)
+        self.assertEqual(self.search.calls, ['a', 'b', 'c', 'b'])
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_single_flight(self):
+        self.search.delay = 0.1
+        cache = self.make_cache()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cache.get('Moscow'))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.search.calls), 1)
+        self.assertEqual(len(set(results)), 1)
+
+    def test_error_not_cached(self):
+        def search(query):
+            calls.append(query)
+            raise ConnectionError
+        calls = []
+        cache = SearchCache(search)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                cache.get('Moscow')
+        self.assertEqual(len(calls), 2)
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.json')
+            cache = self.make_cache(path=path, ttl=10)
+            cache.get('Moscow')
+            cache.get('Kazan')
+            cache.save()
+            self.now = 5
+            cache = self.make_cache(path=path, ttl=10)
+            self.assertEqual(cache.get('Moscow')[0], 'Moscow')
+            self.assertEqual(len(self.search.calls), 2)
+            self.now = 20
+            cache = self.make_cache(path=path, ttl=10)
+            self.assertEqual(cache.stats()['size'], 0)
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_mode_alias(self):
+        with open(os.path.join(os.path.dirname(__file__), 'config')) as f:
+            text = f.read()
+        config_file = tempfile.NamedTemporaryFile('w', suffix='.cfg')
+        self.addCleanup(config_file.close)
+        config_file.write(text.replace('mode = async', 'mode = demon'))
+        config_file.flush()
+        self.assertEqual(server.Config(config_file.name).mode, 'serial')
+
+
+class TestMakeResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.search = StubSearch()
+        server.cache = SearchCache(self.search)
+
+    def test_response(self):
+        self.assertEqual(server.make_response('q=Moscow&format=json'),
+                         "{0: 'Moscow', 1: 'Moscow (disambiguation)'}")
+        server.make_response('q=moscow&format=xml')
+        self.assertEqual(self.search.calls, ['Moscow'])
+
+
+class TestProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.search = StubSearch()
+        server.cache = SearchCache(self.search)
+        server.logger = logging.getLogger('tests')
+        self.config = server.Config(os.path.join(
+            os.path.dirname(__file__), 'config'))
+        self.config.port = 0
+
+    def run_server(self, func):
+        async def main():
+            pool = server.WorkerPool(4)
+            listener = await asyncio.start_server(
+                lambda reader, writer: server.handle_client(
+                    reader, writer, pool, self.config),
+                '127.0.0.1', 0)
+            address = listener.sockets[0].getsockname()
+            async with listener:
+                return await asyncio.to_thread(func, address)
+
+        return asyncio.run(main())
+
+    def test_encode(self):
+        self.assertEqual(protocol.encode('q=a'), b'\x01\x00\x00\x00\x03q=a')
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.encode('a' * (protocol.MAX_SIZE + 1))
+
+    def test_pipeline(self):
+        def func(address):
+            pool = client.ConnectionPool(address, size=1)
+            try:
+                responses = pool.pipeline([f'q={i}&format=json'
+                                           for i in range(50)])
+                responses.append(pool.request('q=' + 'x' * 2000 +
+                                              '&format=json'))
+            finally:
+                pool.close()
+            return responses
+
+        responses = self.run_server(func)
+        self.assertEqual(responses[:2], [
+            "{0: '0', 1: '0 (disambiguation)'}",
+            "{0: '1', 1: '1 (disambiguation)'}",
+        ])
+        self.assertEqual(len(responses[-1]), len(str({
+            0: 'x' * 2000, 1: 'x' * 2000 + ' (disambiguation)'})))
+
+    def test_reset_while_pipelining(self):
+        class ResetWriter:
+            def write(self, data):
+                pass
+
+            async def drain(self):
+                raise ConnectionResetError
+
+        async def main():
+            reader = asyncio.StreamReader()
+            for i in range(300):
+                reader.feed_data(protocol.encode(f'q={i}&format=json'))
+            pool = server.WorkerPool(4)
+            serving = asyncio.create_task(server.serve_framed(
+                None, reader, ResetWriter(), pool, self.config))
+            done, _ = await asyncio.wait((serving,), timeout=2)
+            serving.cancel()
+            return done
+
+        done, = asyncio.run(main())
+        self.assertIsInstance(done.exception(), ConnectionResetError)
+
+    def test_one_shot(self):
+        response = self.run_server(
+            lambda address: client.request_once('q=a&format=json', address))
+        self.assertEqual(response, "{0: 'a', 1: 'a (disambiguation)'}")
+
+
+class TestPrefork(unittest.TestCase):
+
+    def test_restart_crashed_workers(self):
+        config = server.Config(os.path.join(os.path.dirname(__file__),
+                                            'config'))
+        config.port = 0
+        config.processes = 1
+        config.reuse_port = False
+        config.metrics_port = 0
+        crashes = tempfile.NamedTemporaryFile()
+        self.addCleanup(crashes.close)
+
+        async def crash(config, sock=None):
+            with open(crashes.name, 'a') as log:
+                log.write(f'{os.getpid()}\n')
+            raise RuntimeError('crashed at start')
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 2)
+                server.logger = logging.getLogger('tests.prefork')
+                server.serve_async = crash
+                server.serve_prefork(config)
+                status = 0
+            finally:
+                os._exit(status)
+        time.sleep(2.5)
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        with open(crashes.name) as log:
+            self.assertGreaterEqual(len(log.readlines()), 2)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_combine(self):
+        slots = Metrics.shared(2)
+        slots[0].request(0.5)
+        slots[1].request(0.25)
+        slots[1].request(1.0)
+        slots[1].error('timeout')
+        total = Metrics.combine(slots).snapshot()
+        self.assertEqual(total['requests'], 3)
+        self.assertEqual(total['errors']['timeout'], 1)
+        self.assertEqual(total['time'], 1.75)
+        self.assertEqual(total['max_time'], 1.0)
+
+    def test_render(self):
+        metrics = Metrics()
+        for elapsed in (0.00005, 0.003, 20):
+            metrics.observe('search', elapsed)
+        metrics.error('missing_args')
+        lines = metrics.render().splitlines()
+        self.assertIn('search_errors_total{type="missing_args"} 1', lines)
+        self.assertIn('search_phase_seconds_bucket{phase="search",'
+                      'le="0.0001"} 1', lines)
+        self.assertIn('search_phase_seconds_bucket{phase="search",'
+                      'le="0.005"} 2', lines)
+        self.assertIn('search_phase_seconds_bucket{phase="search",'
+                      'le="+Inf"} 3', lines)
+        self.assertIn('search_phase_seconds_count{phase="search"} 3', lines)
+        self.assertIn('search_phase_seconds_sum{phase="search"} 20.00305',
+                      lines)
+
+
+if __name__ == '__main__':
+    unittest.main()